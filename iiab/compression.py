@@ -0,0 +1,130 @@
+# Gzip compression of text responses
+#
+# Responses with a text mimetype are gzipped for clients which accept it.
+# Responses with a strong ETag come from immutable sources (ZIM articles,
+# htmlz entries, static files), so their compressed bodies are cached and
+# each is compressed only once.  The compressed variant gets an ETag of
+# its own, see gzip_etag, so byte ranges and If-Range validators of one
+# variant are never applied to the other.
+import types
+import zlib
+
+from flask import request
+
+from utils import ByteBudgetCache
+
+DEFAULT_GZIP_CACHE_BYTES = 16 * 1024 * 1024
+DEFAULT_GZIP_MIN_SIZE = 500
+GZIP_LEVEL = 6
+GZIP_ETAG_SUFFIX = '-gzip'
+
+# Compressible mimetypes besides text/*, including the non-standard
+# stylesheet/css found in ZIM files
+COMPRESSIBLE_MIMETYPES = set([
+    'application/json',
+    'application/javascript',
+    'application/x-javascript',
+    'application/xml',
+    'application/xhtml+xml',
+    'image/svg+xml',
+    'stylesheet/css',
+])
+
+
+def is_compressible(mimetype):
+    return mimetype is not None and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+def accepts_gzip():
+    """True if the request's Accept-Encoding allows gzip"""
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        parts = coding.strip().split(';')
+        if parts[0].strip().lower() in ('gzip', '*'):
+            # Only an explicit q=0 refuses it
+            for param in parts[1:]:
+                name, _, value = param.strip().partition('=')
+                if name == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+
+def gzip_etag(etag):
+    """Returns the ETag of the gzipped variant of a response with etag"""
+    return etag + GZIP_ETAG_SUFFIX
+
+
+def gzip_data(data, level=GZIP_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class GzipCompressor(object):
+    """Flask extension compressing text responses from an after_request
+    handler.  Bodies streamed from generators, responses sent with
+    X-Sendfile, anything other than a 200 and bodies shorter than min_size
+    are left alone, although 304s of compressible responses get the same
+    Vary header.  Files passed through by send_file are read and
+    compressed.
+
+    Compressed responses are not range requestable: Accept-Ranges is
+    dropped and the ETag becomes gzip_etag() of the original one."""
+
+    def __init__(self, app=None, cache_bytes=DEFAULT_GZIP_CACHE_BYTES, min_size=DEFAULT_GZIP_MIN_SIZE):
+        self.cache = ByteBudgetCache(cache_bytes)
+        self.min_size = min_size
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
+
+    def after_request(self, response):
+        if not is_compressible(response.mimetype):
+            return response
+        if response.status_code == 304:
+            # A 304 carries the Vary header of the response it stands for
+            response.vary.add('Accept-Encoding')
+            return response
+        if response.status_code != 200:
+            return response
+        if 'Content-Encoding' in response.headers or 'X-Sendfile' in response.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        if not accepts_gzip():
+            return response
+
+        # send_file responses pass the file through; read them instead.
+        # Generators, such as large ZIM blobs sent in chunks, keep streaming
+        if isinstance(response.response, types.GeneratorType):
+            return response
+        if response.direct_passthrough:
+            response.direct_passthrough = False
+        elif response.is_streamed:
+            return response
+
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            key = (request.path, etag)
+            compressed = self.cache.get(key)
+        else:
+            key = None
+            compressed = None
+
+        if compressed is None:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            compressed = gzip_data(data)
+            if key is not None:
+                self.cache.put(key, compressed, len(compressed))
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers.pop('Accept-Ranges', None)
+        if etag is not None:
+            response.set_etag(gzip_etag(etag), weak=weak)
+        return response
@@ -18,8 +18,6 @@ from gutenberg_content import find_htmlz, find_epub
 from config import config
 
 from whoosh_search import paginated_search
-from whoosh.index import open_dir
-from utils import whoosh_open_dir_32_or_64
 
 from .endpoint_description import EndPointDescription
 
@@ -67,8 +65,7 @@ def search():
     if query:
         index_dir = config().get_path('GUTENBERG', 'index_dir')
         page = int(request.args.get('page', 1))
-        ix = whoosh_open_dir_32_or_64(index_dir)
-        (pagination, suggestion) = paginated_search(ix, DEFAULT_SEARCH_COLUMNS, query, page, sort_column='creator')
+        (pagination, suggestion) = paginated_search(index_dir, DEFAULT_SEARCH_COLUMNS, query, page, sort_column='creator')
     else:
         flash(_('Please input keyword(s)'), 'error')
     #print pagination.items
@@ -215,20 +212,17 @@ def choose_file(textId):
 def autocomplete():
     term = request.args.get('term', '')
     if term != '':
-        index_dir = config().get_path('GUTENBERG', 'index_dir')
-        ix = open_dir(index_dir)
-        with ix.searcher() as searcher:
-            # might use whoosh.analysis.*Analyzer to break query up
-            # for matching. However it isn't clear how to combine completion
-            # of partial matches across several different columns without
-            # lots of effort
-
-            # Be aware that returning a json top-level array leaves us vulnerable to CSRF.
-            # http://flask.pocoo.org/docs/security/ In this case this is not of significant
-            # concern because the information is not sensitive.  We use a top-level array
-            # because this is what jquery autocomplete demands for use without modification.
-            suggestions = get_autocomplete_matches(term)
-            return Response(response=json.dumps(suggestions), mimetype="application/json")
+        # might use whoosh.analysis.*Analyzer to break query up
+        # for matching. However it isn't clear how to combine completion
+        # of partial matches across several different columns without
+        # lots of effort
+
+        # Be aware that returning a json top-level array leaves us vulnerable to CSRF.
+        # http://flask.pocoo.org/docs/security/ In this case this is not of significant
+        # concern because the information is not sensitive.  We use a top-level array
+        # because this is what jquery autocomplete demands for use without modification.
+        suggestions = get_autocomplete_matches(term)
+        return Response(response=json.dumps(suggestions), mimetype="application/json")
     else:
         # Choosing an inefficient redirect because still testing different
         # approaches and its easier to centralize the handling.  If we keep
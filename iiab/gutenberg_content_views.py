@@ -1,5 +1,7 @@
-from flask import Blueprint, abort, send_file
+from flask import Blueprint, Response, abort, send_file
+import os
 import zipfile
+import mimetypes
 
 from gutenberg_content import find_htmlz, find_epub
 
@@ -15,11 +17,17 @@ def htmlz(pgid, path):
         print "HTMLZ Path not found " + str(pgid)
         abort(404)
     zf = zipfile.ZipFile(htmlz_path)
-    f = zf.open(path)
+    info = zf.getinfo(path)
+    f = zf.open(info)
     data = f.read()
     f.close()
     zf.close()
-    return data
+    mimetype = mimetypes.guess_type(path)[0] or 'text/html'
+    response = Response(data, mimetype=mimetype)
+    # Entries never change for a given htmlz file, which lets
+    # compressed copies of them be cached
+    response.set_etag("%d-%x-%x" % (pgid, info.CRC, int(os.path.getmtime(htmlz_path))))
+    return response
 
 
 # This doesn't work because the relative paths are wrong
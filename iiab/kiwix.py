@@ -1,18 +1,25 @@
 #!/usr/bin/env python
 
-from xml.etree import ElementTree as etree
+try:
+    from xml.etree import cElementTree as etree
+except ImportError:
+    from xml.etree import ElementTree as etree
 from base64 import b64decode
+import threading
 import iso639
 import os
 
 def clean_book(book):
-    """Fixes up the book data"""
+    """Fixes up the book data.  The favicon is left out, see
+    Library.favicon()"""
     clean_book = {}
     for k, v in book.items():
         if k == "favicon":
-            v = b64decode(v)
+            continue
         elif k == "mediaCount":
             v = int(v)
+        elif k == "articleCount":
+            v = int(v)
         elif k == "size":
             v = int(v)
         elif k == "language":
@@ -39,42 +46,71 @@ def clean_book(book):
 
 class Library(object):
     def __init__(self, xml_filename):
-        self.books = {}
+        self.books = []
+        self.books_by_uuid = {}
+        # Favicons are kept base64 encoded until asked for
+        self.favicons = {}
         self._parse_library(xml_filename)
+        self.languages = self._group_by_language()
 
     def _parse_library(self, library_xml_filename):
-        """Parse a kiwix library xml file"""
+        """Parse a kiwix library xml file one book element at a time"""
         with open(library_xml_filename, "r") as f:
-            et = etree.parse(f)
-            root = et.getroot()
-            self.books = root.findall("book")
-        self.books = map(clean_book, self.books)
+            for event, elem in etree.iterparse(f):
+                if elem.tag != "book":
+                    continue
+                book = clean_book(elem.attrib)
+                self.books.append(book)
+                if 'id' in book:
+                    self.books_by_uuid[book['id']] = book
+                    if 'favicon' in elem.attrib:
+                        self.favicons[book['id']] = elem.attrib['favicon']
+                elem.clear()
 
     def find_by_uuid(self, uuid):
-        for book in self.books:
-            if book['id'] == uuid:
-                return book
-        return None
+        return self.books_by_uuid.get(uuid)
 
-    def books_by_language(self):
-        """Get a list of all unique languages found in the library,
-        sorted in decreasing order of total number of articles in that language"""
+    def favicon(self, uuid):
+        """Returns the decoded favicon image of a book, or None"""
+        favicon = self.favicons.get(uuid)
+        if favicon is None:
+            return None
+        return b64decode(favicon)
+
+    def _group_by_language(self):
         langs = dict()
-        for book in library:
+        for book in self.books:
             lang = book['language']
-            langEng = book['languageEnglish']
-            articles = book['articleCount']
-            self.books = []
-            if lang in langs:
-                articles += langs[lang].get('articleCount', 0)
-                self.books = langs[lang].get('self.books', [])
-            self.books.append(book)
-            langs[lang] = {
-                'language': lang,
-                'languageEnglish': langEng,
-                'articleCount': articles,
-                'self.books': self.books
-            }
+            if lang not in langs:
+                langs[lang] = {
+                    'language': lang,
+                    'languageEnglish': book['languageEnglish'],
+                    'articleCount': 0,
+                    'books': [],
+                }
+            langs[lang]['articleCount'] += book.get('articleCount', 0)
+            langs[lang]['books'].append(book)
         langs = langs.values()
         langs.sort(key=lambda x: -x['articleCount'])
         return langs
+
+    def books_by_language(self):
+        """Get a list of all unique languages found in the library,
+        sorted in decreasing order of total number of articles in that language"""
+        return self.languages
+
+
+_library_cache = {}
+_library_lock = threading.Lock()
+
+def load_library(xml_filename):
+    """Returns the parsed Library for a kiwix library xml file, parsing
+    it again only when the file's modification time has changed"""
+    mtime = os.path.getmtime(xml_filename)
+    with _library_lock:
+        cached = _library_cache.get(xml_filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        library = Library(xml_filename)
+        _library_cache[xml_filename] = (mtime, library)
+        return library
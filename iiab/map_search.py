@@ -1,6 +1,6 @@
 # Internet-in-a-Box System
 # By Braddock Gaskill, 16 Feb 2013
-from utils import whoosh_open_dir_32_or_64
+from whoosh_search import shared_index_registry
 from whoosh.qparser import QueryParser
 from whoosh.sorting import ScoreFacet, FunctionFacet
 from whoosh.query import Term
@@ -51,19 +51,20 @@ class FunctionWeighting(scoring.WeightingModel):
 
 
 class IndexAccessor(object):
-    """Helper class to hold open index to avoid performance penalty when opening it on each query
+    """Helper class holding the sort, collapse and weighting settings of the
+    map index.  The index itself is kept open by shared_index_registry.
 
     Supports use with `with` managed context.  If a managed context is not
     used, one must call `open` prior to use
 
-    :attr ix: contains reference to opened whoosh index
+    :method searcher: context manager giving a searcher with the map weighting
     :method search_args: whoosh search method arguments populated with default
                 settings.  Augment as needed with update. Expand kwargs when
                 passing to search method.
     """
     def __init__(self, index_dir):
         self.index_dir = index_dir
-        self.ix = None
+        self.weighting = None
 
     def __enter__(self):
         self.open()
@@ -72,7 +73,8 @@ class IndexAccessor(object):
         self.close()
 
     def open(self):
-        self.ix = whoosh_open_dir_32_or_64(self.index_dir)
+        # Open the index now rather than on the first query
+        shared_index_registry.get(self.index_dir)
 
         # Setup sort and collapse facet. Sort based on importance field and then by score.
         # Collapse based on geoid to eliminate duplicate names
@@ -96,8 +98,12 @@ class IndexAccessor(object):
         self.weighting = FunctionWeighting(position_score_fn)
 
     def close(self):
-        self.ix.close()
-        self.ix = None
+        self.weighting = None
+
+    def searcher(self, weighting=None):
+        if weighting is None:
+            weighting = self.weighting
+        return shared_index_registry.searcher(self.index_dir, weighting=weighting)
 
     def search_args(self, queryObj):
         """Return suitable search parameters for whoosh searcher call.
@@ -118,7 +124,8 @@ class MapSearch(object):
 
     @classmethod
     def init_class(cls, index_dir):
-        """Hold search index open as a class variable for performanc reasons
+        """Hold search settings as a class variable.  The index itself is kept
+        open by shared_index_registry for performance reasons
 
         :param index_dir: directory path containing whoosh index
 
@@ -137,16 +144,15 @@ class MapSearch(object):
         :param autocomplete: flag indicating whether full record or just autocomplete matches should be returned
         """
 
-        if not MapSearch.ix_helper or not MapSearch.ix_helper.ix:
+        if not MapSearch.ix_helper or not MapSearch.ix_helper.weighting:
             raise ValueError("Not initialized. Must call init_mod to initialize before use.")
 
         query = unicode(query)  # Must be unicode
-        ix = MapSearch.ix_helper.ix
-        with ix.searcher(weighting=MapSearch.ix_helper.weighting) as searcher:
+        with MapSearch.ix_helper.searcher() as searcher:
             if autocomplete:
-                query = QueryParser("ngram_fullname", ix.schema).parse(query)
+                query = QueryParser("ngram_fullname", searcher.schema).parse(query)
             else:
-                query = QueryParser("fullname", ix.schema).parse(query)
+                query = QueryParser("fullname", searcher.schema).parse(query)
 
             args = MapSearch.ix_helper.search_args(query)
 
@@ -184,9 +190,8 @@ class MapSearch(object):
     def count(self, query):
         """Return total number of matching documents in index"""
         query = unicode(query)  # Must be unicode
-        ix = MapSearch.ix
-        with ix.searcher() as searcher:
-            query = QueryParser("fullname", ix.schema).parse(query)
+        with MapSearch.ix_helper.searcher(weighting=scoring.BM25F) as searcher:
+            query = QueryParser("fullname", searcher.schema).parse(query)
             results = searcher.search(query)
             n = len(results)
         return n
@@ -1,6 +1,8 @@
 # Misc utility functions
 # By Braddock Gaskill, Feb 2013
 from subprocess import Popen, PIPE
+from collections import OrderedDict
+import threading
 import re
 import sys
 
@@ -46,6 +48,70 @@ def whoosh2dict(hits):
     return m
 
 
+class ByteBudgetCache(object):
+    """Thread safe least recently used cache bounded by the total size in
+    bytes of the values it holds, for caching response bodies.  The size
+    of each value is given when it is put, and values larger than the
+    whole budget are not cached."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the value cached under key or None"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            if nbytes > self.budget:
+                return
+            self.entries[key] = (value, nbytes)
+            self.bytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self.bytes > self.budget:
+            key, (value, nbytes) = self.entries.popitem(last=False)
+            self.bytes -= nbytes
+
+    def set_budget(self, budget):
+        """Sets the memory budget in bytes"""
+        with self.lock:
+            self.budget = budget
+            self._evict()
+
+    def stats(self):
+        """Returns a dictionary of the cache counters"""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes': self.bytes,
+                'budget': self.budget,
+                'entries': len(self.entries),
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+
 def run_mount():
     """Run the mount command and return the parsed results"""
     p = Popen(['mount'], stdout=PIPE)
@@ -16,6 +16,9 @@ import zim_views
 import settings_views
 from babel_patch import babel_patched_load
 import map_search
+import zimpy
+import whoosh_search
+from compression import GzipCompressor
 
 
 def create_app(debug=True, enable_profiler=False, profiler_quiet=False, enable_timepro=False):
@@ -54,12 +57,24 @@ def create_app(debug=True, enable_profiler=False, profiler_quiet=False, enable_t
     gutenberg.set_flask_app(app)
     gutenberg.init_db()
 
+    cluster_cache_mb = config().getint('ZIM', 'cluster_cache_mb')
+    zimpy.shared_cluster_cache.set_budget(cluster_cache_mb * 1024 * 1024)
+    article_cache_mb = config().getint('ZIM', 'article_cache_mb')
+    zim_views.article_cache.set_budget(article_cache_mb * 1024 * 1024)
+    zimpy.shared_zim_file_pool.set_limits(config().getint('ZIM', 'max_open_files'),
+                                          config().getint('ZIM', 'idle_timeout'))
+    search_cache_mb = config().getint('WEBAPP', 'search_cache_mb')
+    whoosh_search.result_cache.set_budget(search_cache_mb * 1024 * 1024)
+
     osm_search_dir = config().get_path('OSM', 'osm_search_dir')
     map_search.MapSearch.init_class(osm_search_dir)
     map_search.init_db(app)
 
     configure_babel(app)
 
+    GzipCompressor(app, cache_bytes=config().getint('WEBAPP', 'gzip_cache_mb') * 1024 * 1024,
+                   min_size=config().getint('WEBAPP', 'gzip_min_size'))
+
     # Auto Index the software repository
     autoindex = AutoIndex(app, add_url_rules=False)
     # FIXME: this should be done more elegantly -bcg'13
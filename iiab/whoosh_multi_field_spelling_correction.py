@@ -3,6 +3,8 @@
 """This module contains helper functions for correcting typos in user queries.
 """
 
+import time
+
 from whoosh import query
 from whoosh.spelling import QueryCorrector, Correction
 
@@ -38,7 +40,11 @@ class MultiFieldQueryCorrector(QueryCorrector):
         self.prefix = prefix
         self.maxdist = maxdist
 
-    def correct_query(self, q, qstring):
+    def correct_query(self, q, qstring, deadline=None):
+        """
+        :param deadline: optional time.time() value after which no more
+            words are looked up, leaving the remaining ones uncorrected.
+        """
         correctors = self.correctors
         termset = self.termset
         prefix = self.prefix
@@ -53,6 +59,8 @@ class MultiFieldQueryCorrector(QueryCorrector):
         for token in q.all_tokens():
             fname = token.fieldname
             if (fname, token.text) in termset:
+                if deadline is not None and time.time() > deadline:
+                    break
                 sugs = correctors[fname].suggest(token.text, prefix=prefix,
                                                  maxdist=maxdist)
                 if sugs:
@@ -1,11 +1,36 @@
 import os
+import logging
+import threading
+import time
+import weakref
+from array import array
+from contextlib import contextmanager
 
 from whoosh.qparser import MultifieldParser
+from whoosh.searching import Searcher
 from whoosh import scoring
 
 from .whoosh_multi_field_spelling_correction import MultiFieldQueryCorrector
+from utils import whoosh_open_dir_32_or_64, ByteBudgetCache
 import pagination_helper
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_IDLE_READERS = 4
+DEFAULT_RESULT_CACHE_BYTES = 4 * 1024 * 1024
+# Number of ranked hits kept for each cached query, enough for the
+# first pages of results
+CACHED_HITS = 200
+# Spelling suggestions are only looked for when a query has fewer hits
+# than this, and looking for them stops after this many seconds
+SPELLING_MAX_HITS = 10
+SPELLING_TIME_BUDGET = 0.25
+# Words whose suggestions are remembered by each corrector
+MAX_MEMO_WORDS = 10000
+# Layout of the static_rank column of ZIM indexes, see zim_static_rank
+STATIC_RANK_IMAGE_SHIFT = 32
+STATIC_RANK_MAX_LINKS = (1 << STATIC_RANK_IMAGE_SHIFT) - 1
+
 def index_directory_path(base_path, zim_name):
     """Returns the directory where a ZIM file's index should be located, given
     a base path where all the index files are located as well as a filename
@@ -16,7 +41,148 @@ def index_directory_path(base_path, zim_name):
     return index_dir
 
 
-def get_query_corrections(searcher, query, qstring):
+def zim_static_rank(title, reverse_links):
+    """Returns the query independent rank of a ZIM article stored in the
+    static_rank column of its index, which sorts in ascending order with
+    pages whose title starts with "Image:" after regular articles, then by
+    decreasing number of links to the article.  The image flag is kept in
+    the high bits so that it can be recovered with zim_static_rank_image."""
+    image = 1 if title.startswith(u"Image:") else 0
+    links = min(reverse_links or 0, STATIC_RANK_MAX_LINKS)
+    return (image << STATIC_RANK_IMAGE_SHIFT) | (STATIC_RANK_MAX_LINKS - links)
+
+
+def zim_static_rank_image(static_rank):
+    """Returns 1 for the static rank of an image page and 0 otherwise"""
+    return static_rank >> STATIC_RANK_IMAGE_SHIFT
+
+
+class IndexRegistry(object):
+    """Opens each Whoosh index once per process and hands out searchers
+    over readers that are kept open between requests.
+
+    Indexes are opened with whoosh_open_dir_32_or_64, so mmap is only used
+    on 64-bit machines.  Readers are not shared between threads: each
+    searcher checks one out and returns it when done, and up to
+    max_idle_readers are kept per index.  Every checkout compares the
+    index's generation on disk with the one opened, and when an index is
+    rewritten it is opened again and readers of the old generation are
+    closed as they come back."""
+
+    def __init__(self, max_idle_readers=DEFAULT_MAX_IDLE_READERS):
+        self.max_idle_readers = max_idle_readers
+        self.lock = threading.Lock()
+        # Index directory -> {'ix', 'generation', 'idle'}
+        self.entries = {}
+
+    def _open(self, index_dir):
+        ix = whoosh_open_dir_32_or_64(index_dir)
+        return {'ix': ix, 'generation': ix.latest_generation(), 'idle': []}
+
+    def _entry(self, index_dir):
+        """Returns the up to date entry of an index, with the lock held"""
+        entry = self.entries.get(index_dir)
+        if entry is None:
+            entry = self.entries[index_dir] = self._open(index_dir)
+        elif entry['ix'].latest_generation() != entry['generation']:
+            logger.info("Whoosh index %s changed, opening it again" % index_dir)
+            self._close_entry(entry)
+            entry = self.entries[index_dir] = self._open(index_dir)
+        return entry
+
+    def _close_entry(self, entry):
+        for reader in entry['idle']:
+            reader.close()
+        entry['idle'] = []
+        entry['ix'].close()
+
+    def get(self, index_dir):
+        """Returns the opened index of index_dir"""
+        with self.lock:
+            return self._entry(index_dir)['ix']
+
+    def generation(self, index_dir):
+        """Returns the generation of the opened index of index_dir"""
+        with self.lock:
+            return self._entry(index_dir)['generation']
+
+    def _checkout(self, index_dir):
+        with self.lock:
+            entry = self._entry(index_dir)
+            if entry['idle']:
+                return entry, entry['idle'].pop()
+            ix = entry['ix']
+        # Opening a reader reads the segment files, so do it unlocked
+        return entry, ix.reader()
+
+    def _release(self, index_dir, entry, reader):
+        with self.lock:
+            if self.entries.get(index_dir) is entry and len(entry['idle']) < self.max_idle_readers:
+                entry['idle'].append(reader)
+                return
+        reader.close()
+
+    @contextmanager
+    def searcher(self, index_dir, weighting=scoring.BM25F):
+        """Context manager giving a Searcher of the index in index_dir.
+        The searcher must not be used after the block ends."""
+        entry, reader = self._checkout(index_dir)
+        try:
+            yield Searcher(reader, weighting=weighting, closereader=False, fromindex=entry['ix'])
+        finally:
+            self._release(index_dir, entry, reader)
+
+    def clear(self):
+        """Closes every index and idle reader"""
+        with self.lock:
+            for entry in self.entries.values():
+                self._close_entry(entry)
+            self.entries = {}
+
+
+shared_index_registry = IndexRegistry()
+
+
+class MemoCorrector(object):
+    """Wraps a whoosh Corrector, remembering the suggestions for each word.
+    Like the reader it corrects from it is used by one thread at a time."""
+
+    def __init__(self, corrector):
+        self.corrector = corrector
+        self.memo = {}
+
+    def suggest(self, text, limit=5, maxdist=2, prefix=0):
+        key = (text, limit, maxdist, prefix)
+        sugs = self.memo.get(key)
+        if sugs is None:
+            sugs = self.corrector.suggest(text, limit=limit, maxdist=maxdist, prefix=prefix)
+            if len(self.memo) >= MAX_MEMO_WORDS:
+                self.memo.clear()
+            self.memo[key] = sugs
+        return sugs
+
+
+# Reader -> {fieldname: MemoCorrector}, dropped along with the reader
+_reader_correctors = weakref.WeakKeyDictionary()
+_reader_correctors_lock = threading.Lock()
+
+
+def get_correctors(searcher):
+    """Returns the MemoCorrector of each column with spelling correction
+    support, kept for as long as the searcher's reader is"""
+    reader = searcher.reader()
+    with _reader_correctors_lock:
+        correctors = _reader_correctors.get(reader)
+        if correctors is None:
+            correctors = {}
+            for name, field in searcher.schema.items():
+                if hasattr(field, 'spelling') and field.spelling:
+                    correctors[name] = MemoCorrector(reader.corrector(name))
+            _reader_correctors[reader] = correctors
+        return correctors
+
+
+def get_query_corrections(searcher, query, qstring, time_budget=None):
     """
     Suggest alternate spelling for search terms by searching each column with
     spelling correction support in turn.
@@ -24,19 +190,18 @@ def get_query_corrections(searcher, query, qstring):
     :param searcher: whoosh searcher object
     :param query: whoosh query object
     :param qstring: search string that was passed to the query object
+    :param time_budget: optional number of seconds after which the remaining
+        terms are left uncorrected
     :returns: MultiFieldQueryCorrector with one corrector for each corrected column
     """
-    fieldnames = [name for name, field in searcher.schema.items() if hasattr(field, 'spelling') and field.spelling]
-    correctors = {}
-    for fieldname in fieldnames:
-        if fieldname not in correctors:
-            correctors[fieldname] = searcher.corrector(fieldname)
+    correctors = get_correctors(searcher)
     terms = []
     for token in query.all_tokens():
         if token.fieldname in correctors:
             terms.append((token.fieldname, token.text))
 
-    return MultiFieldQueryCorrector(correctors, terms, prefix=2, maxdist=1).correct_query(query, qstring)
+    deadline = None if time_budget is None else time.time() + time_budget
+    return MultiFieldQueryCorrector(correctors, terms, prefix=2, maxdist=1).correct_query(query, qstring, deadline=deadline)
 
 def deduplicate_corrections(corrections):
     """
@@ -50,26 +215,82 @@ def deduplicate_corrections(corrections):
     return dict((c.string, c) for c in corrections if c.original_query != c.query).values()
 
 
-def paginated_search(ix, search_columns, query_text, page=1, pagelen=20, sort_column=None, weighting=scoring.BM25F):
+# Ranked results of recent queries, see paginated_search
+result_cache = ByteBudgetCache(DEFAULT_RESULT_CACHE_BYTES)
+
+
+class RankedResults(object):
+    """The docnums of the first hits of a query in ranked order, along with
+    the total number of hits and the spelling suggestions for the query"""
+
+    def __init__(self, docnums, total, suggestions):
+        self.docnums = docnums
+        self.total = total
+        self.suggestions = suggestions
+
+    def nbytes(self):
+        return self.docnums.itemsize * len(self.docnums) + sum(len(s) * 2 for s in self.suggestions) + 200
+
+
+def rank_query(searcher, query, query_text, sort_column):
+    """Run query keeping the docnums of the first CACHED_HITS hits.
+    Spelling suggestions are only looked for when there are few hits."""
+    results = searcher.search(query, limit=CACHED_HITS, sortedby=sort_column)
+    docnums = array('I', (docnum for score, docnum in results.top_n))
+    total = len(results)
+    if total < SPELLING_MAX_HITS:
+        corrections = deduplicate_corrections(get_query_corrections(searcher, query, query_text,
+                                                                    time_budget=SPELLING_TIME_BUDGET))  # list of Corrector objects
+        #hf = whoosh.highlight.HtmlFormatter(classname="change")
+        #html = corrections.format_string(hf)
+        suggestions = [c.string for c in corrections]
+    else:
+        suggestions = []
+    return RankedResults(docnums, total, suggestions)
+
+
+def paginated_search(index_dir, search_columns, query_text, page=1, pagelen=20, sort_column=None, weighting=scoring.BM25F,
+                     sort_key=None):
     """
     Return a tuple consisting of an object that emulates an SQLAlchemy pagination object and corrected query suggestion
+    index_dir is the Whoosh index directory, opened through shared_index_registry
     pagelen specifies number of hits per page
     page specifies page of results (first page is 1)
+
+    The ranked hits of a query are kept in result_cache, so further pages
+    and repeats of the query only load the stored fields of the page.
+    Facet objects passed as sort_column can not be compared between
+    requests, so sort_key must then be given to identify the sort order,
+    otherwise the query is not cached.
     """
     query_text = unicode(query_text)  # Must be unicode
+    if sort_key is None and (sort_column is None or isinstance(sort_column, basestring)):
+        sort_key = ('column', sort_column)
 
-    with ix.searcher(weighting=weighting) as searcher:
-        query = MultifieldParser(search_columns, ix.schema).parse(query_text)
-        try:
-            # search_page returns whoosh.searching.ResultsPage
+    with shared_index_registry.searcher(index_dir, weighting=weighting) as searcher:
+        query = MultifieldParser(search_columns, searcher.schema).parse(query_text)
+        if sort_key is not None:
+            cache_key = (index_dir, searcher.reader().generation(), tuple(search_columns), query_text, sort_key)
+            ranked = result_cache.get(cache_key)
+            if ranked is None:
+                ranked = rank_query(searcher, query, query_text, sort_column)
+                result_cache.put(cache_key, ranked, ranked.nbytes())
+        else:
+            ranked = rank_query(searcher, query, query_text, sort_column)
+
+        # Pages past the last one show the last page, as search_page does
+        pagecount = (ranked.total + pagelen - 1) // pagelen
+        offset = (min(page, pagecount) - 1) * pagelen
+        if page < 1 or ranked.total == 0:  # Invalid page number
+            items = []
+            total = 0
+        elif offset + pagelen <= len(ranked.docnums) or len(ranked.docnums) == ranked.total:
+            items = [searcher.stored_fields(docnum) for docnum in ranked.docnums[offset:offset + pagelen]]
+            total = ranked.total
+        else:
+            # Beyond the cached hits
             results = searcher.search_page(query, page, pagelen=pagelen, sortedby=sort_column)
+            items = [dict(r.items()) for r in results]
             total = results.total
-        except ValueError:  # Invalid page number
-            results = []
-            total = 0
-        paginate = pagination_helper.Pagination(page, pagelen, total, [dict(r.items()) for r in results])
-        corrections = deduplicate_corrections(get_query_corrections(searcher, query, query_text))  # list of Corrector objects
-
-        #hf = whoosh.highlight.HtmlFormatter(classname="change")
-        #html = corrections.format_string(hf)
-        return (paginate, [c.string for c in corrections])
+        paginate = pagination_helper.Pagination(page, pagelen, total, items)
+        return (paginate, ranked.suggestions)
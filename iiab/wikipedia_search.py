@@ -2,7 +2,8 @@
 # By Braddock Gaskill, 16 Feb 2013
 from whoosh.qparser import QueryParser
 
-from utils import whoosh2dict, whoosh_open_dir_32_or_64
+from utils import whoosh2dict
+from whoosh_search import shared_index_registry
 
 
 class WikipediaSearch(object):
@@ -18,9 +19,8 @@ class WikipediaSearch(object):
         Set pagelen = None or 0 to retrieve all results.
         """
         query = unicode(query)  # Must be unicode
-        ix = whoosh_open_dir_32_or_64(self.index_dir)
-        with ix.searcher() as searcher:
-            query = QueryParser("title", ix.schema).parse(query)
+        with shared_index_registry.searcher(self.index_dir) as searcher:
+            query = QueryParser("title", searcher.schema).parse(query)
             if pagelen is not None and pagelen != 0:
                 try:
                     results = searcher.search_page(query, page, pagelen=pagelen,
@@ -32,16 +32,13 @@ class WikipediaSearch(object):
                                           sortedby="score", reverse=True)
             #r = [x.items() for x in results]
             r = whoosh2dict(results)
-        ix.close()
         return r
 
     def count(self, query):
         """Return total number of matching documents in index"""
         query = unicode(query)  # Must be unicode
-        ix = whoosh_open_dir_32_or_64(self.index_dir)
-        with ix.searcher() as searcher:
-            query = QueryParser("title", ix.schema).parse(query)
+        with shared_index_registry.searcher(self.index_dir) as searcher:
+            query = QueryParser("title", searcher.schema).parse(query)
             results = searcher.search(query)
             n = len(results)
-        ix.close()
         return n
@@ -2,13 +2,16 @@ import os
 from glob import glob
 import logging
 import time
+import json
+import tempfile
+import threading
 
 from flask import Blueprint, render_template
 
 from config import config
-from zimpy import ZimFile
+from zimpy import ZimFile, ClusterCache
 from iso639 import iso6392
-from kiwix import Library
+from kiwix import load_library
 import timepro
 import babel.numbers
 
@@ -17,17 +20,29 @@ blueprint = Blueprint('wikipedia_views', __name__,
 
 logger = logging.getLogger(__name__)
 
-#timepro.profile_and_print()
-def organize_books_by_language(filenames, library_file):
-    if not os.path.exists(library_file):
-        logger.error("Can not find Kiwix library file: %s" % library_file)
+CATALOG_VERSION = 1
 
-    kiwix_lib = Library(library_file)
 
-    languages = {}
+def file_stamp(filename):
+    """Returns the modification time and size of a file, or None if it
+    does not exist, for noticing when it has changed"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
 
-    for zim_fn in filenames:
-        zim_obj = ZimFile(zim_fn)
+
+def read_book_data(zim_fn, get_library):
+    """Returns the book data of a ZIM file taken from its metadata, or
+    from the kiwix library returned by get_library() if it has none,
+    along with whether it came from the library.  Returns None, False
+    if the book is found in neither."""
+    # The file is opened on its own rather than through the pool, so that
+    # scanning the library does not push out the files being served, and
+    # with its own cluster cache so nothing read here keeps it open
+    zim_obj = ZimFile(zim_fn, cluster_cache=ClusterCache())
+    try:
         t0 = time.time()
         book_data = zim_obj.metadata()
         if time.time() - t0 > 0.5:
@@ -36,24 +51,42 @@ def organize_books_by_language(filenames, library_file):
         # Make sure book has metadata, if not look up in kiwix library
         # This solution allows us to add zim files not in the kiwix library
         # while still having a backup for files that do not have metadata
+        from_library = False
         if not book_data.has_key('language'):
             logger.info("No metadata, looking for book in kiwix library: %s" % zim_fn)
-            book_data = kiwix_lib.find_by_uuid(zim_obj.get_kiwix_uuid())
+            kiwix_lib = get_library()
+            if kiwix_lib is not None:
+                book_data = kiwix_lib.find_by_uuid(zim_obj.get_kiwix_uuid())
+            else:
+                book_data = None
             if book_data == None:
                 logger.info("Book missing in kiwix library as well, skipping: %s" % zim_fn)
-                continue
+                return None, False
+            from_library = True
 
-        # Decode strings from UTF-8 into unicode objects
-        for k,v in book_data.items():
+        # Decode strings from UTF-8 into unicode objects, leaving out binary
+        # values such as favicons which are not shown
+        book = {}
+        for k, v in book_data.items():
             if type(v) is str:
-                book_data[k] = v.decode('utf-8')
+                try:
+                    v = v.decode('utf-8')
+                except UnicodeDecodeError:
+                    continue
+            book[k] = v
+
+        # Count only entries in the article namespace as Kiwix does
+        book['articleCount'] = zim_obj.namespace_count('A')
+        book['humanReadableId'] = os.path.splitext(os.path.basename(zim_fn))[0]
+        return book, from_library
+    finally:
+        zim_obj.close()
+
 
-        # Format article count as string with commas
-        articleCount = zim_obj.header['articleCount']
-        #book_data['articleCount'] = "{:,d}".format(articleCount)
-        book_data['articleCount'] = babel.numbers.format_number(articleCount)
-        book_data['humanReadableId'] = os.path.splitext(os.path.basename(zim_fn))[0]
+def organize_books_by_language(books):
+    languages = {}
 
+    for book_data in books:
         if not languages.has_key(book_data['language']):
             lang_data = {}
             if iso6392.has_key(book_data['language']):
@@ -68,20 +101,148 @@ def organize_books_by_language(filenames, library_file):
             lang_data = languages[book_data['language']]
 
         lang_data['books'].append(book_data)
-        lang_data['articleCount'] = lang_data['articleCount'] + articleCount
+        lang_data['articleCount'] = lang_data['articleCount'] + book_data['articleCount']
 
     langs = languages.values()
     langs.sort(key=lambda x: -x['articleCount'])
     return langs
 
+
+class BookCatalog(object):
+    """The books of the ZIM directory organized by language, persisted
+    as JSON so that each ZIM file only has to be opened and its metadata
+    read when it is new or has changed.
+
+    Every use checks the modification time and size of each ZIM file and
+    of the kiwix library against the catalog, and only re-reads the books
+    which changed.  If the catalog file can not be written the catalog is
+    only kept in memory."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.catalog_file = None
+        self.library_stamp = None
+        # ZIM file name -> {'stamp', 'book', 'from_library'}
+        self.entries = {}
+        self.languages = None
+        self.writable = True
+
+    def _load(self, catalog_file):
+        self.catalog_file = catalog_file
+        self.library_stamp = None
+        self.entries = {}
+        self.languages = None
+        self.writable = True
+        if not os.path.exists(catalog_file):
+            return
+        try:
+            with open(catalog_file, "r") as f:
+                catalog = json.load(f)
+            if catalog.get('version') == CATALOG_VERSION:
+                self.library_stamp = catalog['library']
+                # File names come back from JSON as unicode, glob gives bytes
+                self.entries = dict((zim_fn.encode('utf-8'), entry) for zim_fn, entry in catalog['books'].items())
+        except (IOError, ValueError, KeyError), e:
+            logger.warning("Ignoring unreadable book catalog %s: %s" % (catalog_file, e))
+
+    def _save(self):
+        if not self.writable:
+            return
+        catalog = {
+            'version': CATALOG_VERSION,
+            'library': self.library_stamp,
+            'books': self.entries,
+        }
+        # Server processes may save at the same time, so each writes its
+        # own temporary file and renames it over the catalog
+        tmp_file = None
+        try:
+            fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(self.catalog_file) + ".",
+                                            dir=os.path.dirname(self.catalog_file))
+            with os.fdopen(fd, "w") as f:
+                json.dump(catalog, f)
+            # mkstemp creates files only their owner can read
+            os.chmod(tmp_file, 0644)
+            os.rename(tmp_file, self.catalog_file)
+        except (IOError, OSError), e:
+            logger.warning("Can not write book catalog %s, keeping it in memory only: %s" % (self.catalog_file, e))
+            self.writable = False
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _refresh(self, filenames, library_file):
+        """Brings the entries up to date, returning True if any changed"""
+        changed = False
+
+        library_stamp = file_stamp(library_file)
+        if library_stamp != self.library_stamp:
+            # Books looked up in the old library, or missing from it,
+            # need looking up again
+            for zim_fn, entry in self.entries.items():
+                if entry['from_library'] or entry['book'] is None:
+                    del self.entries[zim_fn]
+            self.library_stamp = library_stamp
+            changed = True
+
+        libraries = []
+
+        def get_library():
+            if not libraries:
+                if os.path.exists(library_file):
+                    libraries.append(load_library(library_file))
+                else:
+                    logger.error("Can not find Kiwix library file: %s" % library_file)
+                    libraries.append(None)
+            return libraries[0]
+
+        for zim_fn in set(self.entries) - set(filenames):
+            del self.entries[zim_fn]
+            changed = True
+
+        for zim_fn in filenames:
+            stamp = file_stamp(zim_fn)
+            entry = self.entries.get(zim_fn)
+            if entry is not None and entry['stamp'] == stamp:
+                continue
+            book, from_library = read_book_data(zim_fn, get_library)
+            self.entries[zim_fn] = {'stamp': stamp, 'book': book, 'from_library': from_library}
+            changed = True
+
+        return changed
+
+    def get_languages(self, catalog_file, filenames, library_file):
+        """Returns the books of filenames organized by language, sorted
+        by decreasing number of articles"""
+        with self.lock:
+            if catalog_file != self.catalog_file:
+                self._load(catalog_file)
+            if self._refresh(filenames, library_file):
+                self._save()
+                self.languages = None
+            if self.languages is None:
+                books = [self.entries[zim_fn]['book'] for zim_fn in sorted(self.entries)]
+                self.languages = organize_books_by_language([book for book in books if book is not None])
+            return self.languages
+
+
+book_catalog = BookCatalog()
+
+
 @blueprint.route('/')
 def wikipedia_view():
     wikipedia_zim_dir = config().get('ZIM', 'wikipedia_zim_dir')
     library_file = config().get('ZIM', 'kiwix_library_file')
     old_library_file = config().get('ZIM', 'old_kiwix_library_file')
+    catalog_file = config().get('ZIM', 'catalog_file')
     # Old location before being moved, for backwards compatibility
     if not os.path.exists(library_file):
         logger.info("Kiwix library file not found at: %s, using old location: %s" % (library_file, old_library_file))
         library_file = old_library_file
-    langs = organize_books_by_language(glob(os.path.join(wikipedia_zim_dir, "*.zim")), library_file)
-    return render_template('wikipedia_index.html', languages=langs)
+    langs = book_catalog.get_languages(catalog_file, glob(os.path.join(wikipedia_zim_dir, "*.zim")), library_file)
+
+    # Format article counts as strings with commas for the current locale
+    languages = []
+    for lang in langs:
+        books = [dict(book, articleCount=babel.numbers.format_number(book['articleCount'])) for book in lang['books']]
+        languages.append(dict(lang, books=books))
+    return render_template('wikipedia_index.html', languages=languages)
@@ -0,0 +1,99 @@
+# Parallel scans over the articles of a ZIM file
+#
+# The articles selected for a scan are put in cluster order once, then
+# split into chunks that never share a cluster.  Each chunk is handed
+# to a worker process which opens its own ZimFile, so no file handles
+# or decompressors are shared, and decompresses each of its clusters
+# exactly once.  The per-chunk results are merged with a reducer as
+# they arrive.
+import logging
+import multiprocessing
+
+from zimpy import ZimFile
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNKS_PER_PROCESS = 4
+
+
+def split_at_clusters(zim_file, indexes, parts):
+    """Split a cluster ordered array of article indexes into at most parts
+    slices of roughly equal length, moving each boundary forward so that
+    the articles of one cluster all end up in the same slice."""
+    chunks = []
+    start = 0
+    step = max(1, (len(indexes) + parts - 1) // parts)
+    while start < len(indexes):
+        stop = min(start + step, len(indexes))
+        if stop < len(indexes):
+            cluster = zim_file.read_directory_entry_by_index(indexes[stop - 1]).clusterNumber
+            while stop < len(indexes) and zim_file.read_directory_entry_by_index(indexes[stop]).clusterNumber == cluster:
+                stop += 1
+        chunks.append(indexes[start:stop])
+        start = stop
+    return chunks
+
+
+def _scan_chunk(args):
+    """Worker side of scan(), run once per chunk"""
+    filename, worker, indexes, with_content = args
+    zim_file = ZimFile(filename)
+    try:
+        if with_content:
+            articles = zim_file.iter_articles_with_content(indexes=indexes)
+        else:
+            articles = ((zim_file.read_directory_entry_by_index(i), None) for i in indexes)
+        return len(indexes), worker(zim_file, articles)
+    finally:
+        zim_file.close()
+
+
+def scan(filename, worker, reducer, initial, namespaces=None, mimetypes=None,
+         with_content=True, processes=None, chunks_per_process=DEFAULT_CHUNKS_PER_PROCESS,
+         progress=None):
+    """Scan the articles of a ZIM file selected by namespaces and mimetypes
+    (as in ZimFile.cluster_ordered_indexes) using a pool of processes.
+
+    worker(zim_file, articles) is called in a worker process for each
+    chunk, articles being an iterator over (dirent, blob) pairs, with blob
+    None when with_content is False.  It must be a module level function
+    so it can be pickled, and its return value is merged into initial with
+    reducer(result, chunk_result) in the calling process.  progress, if
+    given, is called as progress(done, total) with article counts after
+    each chunk is merged.  processes defaults to the number of CPUs, and
+    a single process runs the chunks inline without a pool."""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    zim_file = ZimFile(filename)
+    try:
+        indexes = zim_file.cluster_ordered_indexes(namespaces, mimetypes)
+        chunks = split_at_clusters(zim_file, indexes, processes * chunks_per_process)
+    finally:
+        zim_file.close()
+
+    logger.debug("Scanning %d articles of %s in %d chunks with %d processes" % (len(indexes), filename, len(chunks), processes))
+
+    tasks = [(filename, worker, chunk, with_content) for chunk in chunks]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_scan_chunk, tasks)
+    else:
+        pool = None
+        results = (_scan_chunk(task) for task in tasks)
+
+    try:
+        result = initial
+        done = 0
+        for count, chunk_result in results:
+            result = reducer(result, chunk_result)
+            done += count
+            if progress is not None:
+                progress(done, len(indexes))
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return result
@@ -1,20 +1,51 @@
 # ZIM file URL views (for Wikipedia)
 import os
 import re
+import json
+from datetime import datetime
 
-from flask import Blueprint, Response, render_template, request, flash, url_for, abort
+from flask import Blueprint, Response, render_template, request, flash, url_for, abort, jsonify
 from flask.ext.babel import gettext as _
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import is_resource_modified
 from whoosh import scoring, sorting
 
-from zimpy import ZimFile
+from zimpy import shared_cluster_cache, shared_zim_file_pool
 from config import config
 
-from whoosh_search import paginated_search
-from utils import whoosh_open_dir_32_or_64
+from whoosh_search import paginated_search, shared_index_registry, result_cache, zim_static_rank_image
+from utils import ByteBudgetCache
+from compression import gzip_etag
 
 from .endpoint_description import EndPointDescription
 
 DEFAULT_RESULTS_PER_PAGE = 20
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = DEFAULT_SUGGESTIONS * 5
+DEFAULT_ARTICLE_CACHE_BYTES = 16 * 1024 * 1024
+
+# Seconds browsers may keep images, stylesheets and other assets outside
+# the article namespace without revalidating.  Asset URLs are named by
+# the ZIM file name, which can be replaced by a new file with different
+# content, so this is kept short.  Revalidating is cheap: the ETag holds
+# the file's UUID and a matching request gets a 304 without reading any
+# cluster.
+ASSET_MAX_AGE = 3600
+
+# Blobs larger than this, such as video and audio, are streamed to the
+# client this many bytes at a time rather than read whole
+BLOB_CHUNK_SIZE = 256 * 1024
+
+# Mimetypes of articles whose links are rewritten
+REWRITE_MIMETYPES = ['text/html; charset=utf-8', 'stylesheet/css', 'text/html']
+
+# Absolute links to other articles in HTML attributes and CSS imports,
+# rewritten in one pass
+link_regex = re.compile(r'''((?:href|src)=["']/|@import[ ]+["']/)([A-Z\-])/''')
+
+# Rewritten HTML and CSS response bodies keyed by
+# (zim uuid, humanReadableId, article index)
+article_cache = ByteBudgetCache(DEFAULT_ARTICLE_CACHE_BYTES)
 
 blueprint = Blueprint('zim_views', __name__,
                       template_folder='templates', static_folder='static')
@@ -22,36 +53,130 @@ blueprint = Blueprint('zim_views', __name__,
 def load_zim_file(humanReadableId):
     zim_dir = config().get_path("ZIM", "wikipedia_zim_dir")
     zim_fn = os.path.join(zim_dir, humanReadableId + ".zim")
-    return ZimFile(zim_fn)
+    return shared_zim_file_pool.get(zim_fn)
 
 def replace_paths(top_url, html):
-    replace = u"\\1\\2" + top_url + "/\\3/"
-    html = re.sub(u'(href|src)(=["\']/)([A-Z\-])/', replace, html)
-    html = re.sub(u'(@import[ ]+)(["\']/)([A-Z\-])/', replace, html)
-    return html
+    replace = "\\1" + top_url.replace("\\", "\\\\") + "/\\2/"
+    return link_regex.sub(replace, html)
 
 def mangle_article(html, mimetype, humanReadableId):
-    if mimetype in ['text/html; charset=utf-8', 'stylesheet/css', 'text/html']:
-        try:
-            html = html.decode('utf-8','replace')
-        except UnicodeDecodeError:
-            try:
-                print "utf-8 decoding failed, falling back to latin1"
-                html = html.decode('latin1')
-            except:
-                print "utf-8 and latin1 decoding failed"
-                return html
-        html = replace_paths("iiab/zim/" + humanReadableId, html)
-    return html
+    """Rewrites links in HTML and CSS articles.  html may be a string or
+    a read-only buffer from ZimFile; it is only copied into a string
+    here, where the response needs it.  The links are plain ASCII, so
+    they are rewritten in the encoded bytes without decoding them."""
+    if mimetype in REWRITE_MIMETYPES:
+        if isinstance(humanReadableId, unicode):
+            humanReadableId = humanReadableId.encode('utf-8')
+        return replace_paths("iiab/zim/" + humanReadableId, str(html))
+    return str(html)
+
+def not_modified_etag(etag, last_modified):
+    """Returns the ETag of the identity or gzipped variant that the
+    request's conditional headers show the client already has, or None"""
+    for variant_etag in (etag, gzip_etag(etag)):
+        if not is_resource_modified(request.environ, etag=variant_etag, last_modified=last_modified):
+            return variant_etag
+    return None
+
+def article_response(zimfile, index, humanReadableId):
+    """Returns the response for the article at index, which must not be
+    a redirect.  Rewritten HTML and CSS bodies are served from
+    article_cache when possible, skipping decompression and rewriting.
+
+    Responses carry a strong ETag made of the ZIM UUID and article index
+    along with the file modification time, and conditional requests
+    matching them are answered with 304 before any cluster is read.
+    GzipCompressor gives gzipped responses gzip_etag() of that ETag,
+    which is matched here too."""
+    entry = zimfile.read_directory_entry_by_index(index)
+    etag = "%s-%d" % (zimfile.uuid.hex, index)
+    last_modified = datetime.utcfromtimestamp(int(zimfile.mtime))
+
+    not_modified = not_modified_etag(etag, last_modified)
+    if not_modified is not None:
+        etag = not_modified
+        # The mimetype is not sent, but lets GzipCompressor add Vary
+        # as it would for the full response
+        response = Response(status=304, mimetype=zimfile.mimeTypeList[entry.mimetype])
+    elif zimfile.mimeTypeList[entry.mimetype] not in REWRITE_MIMETYPES:
+        response = blob_response(zimfile, entry, etag, last_modified)
+    else:
+        key = (zimfile.uuid, humanReadableId, index)
+        cached = article_cache.get(key)
+        if cached is not None:
+            body, mimetype = cached
+        else:
+            article, mimetype, ns = zimfile.get_article_by_index(index, view=True)
+            body = mangle_article(article, mimetype, humanReadableId)
+            if mimetype in REWRITE_MIMETYPES:
+                article_cache.put(key, (body, mimetype), len(body))
+        response = Response(body, mimetype=mimetype)
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    if entry.namespace == 'A':
+        # Articles are revalidated so that link rewriting changes show up
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = ASSET_MAX_AGE
+    return response
+
+def range_applies(etag, last_modified):
+    """True unless an If-Range header asks for the whole blob because
+    it no longer matches.  The ETag of a gzipped variant never matches,
+    since ranges are always of the identity body."""
+    if 'If-Range' not in request.headers:
+        return True
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    return if_range.date is not None and last_modified <= if_range.date
+
+def blob_response(zimfile, entry, etag, last_modified):
+    """Returns a response for a blob which is not rewritten, honouring
+    a single byte range request.  Only the bytes sent are read from
+    uncompressed clusters, and large blobs are streamed in chunks."""
+    mimetype = zimfile.mimeTypeList[entry.mimetype]
+    size, read = zimfile.open_blob(entry.clusterNumber, entry.blobNumber)
+
+    start, stop = 0, size
+    status = 200
+    content_range = None
+    ranges = request.range
+    if ranges is not None and len(ranges.ranges) == 1 and range_applies(etag, last_modified):
+        window = ranges.range_for_length(size)
+        if window is None:
+            response = Response(status=416)
+            response.content_range = ContentRange('bytes', None, None, size)
+            return response
+        start, stop = window
+        status = 206
+        content_range = ContentRange('bytes', start, stop, size)
+
+    if stop - start <= BLOB_CHUNK_SIZE:
+        response = Response(read(start, stop - start), status=status, mimetype=mimetype)
+    else:
+        def generate():
+            for offset in xrange(start, stop, BLOB_CHUNK_SIZE):
+                yield read(offset, min(BLOB_CHUNK_SIZE, stop - offset))
+        response = Response(generate(), status=status, mimetype=mimetype, direct_passthrough=True)
+        response.headers['Content-Length'] = str(stop - start)
+
+    if content_range is not None:
+        response.content_range = content_range
+    response.accept_ranges = 'bytes'
+    return response
 
 @blueprint.route('/<humanReadableId>')
 def zim_main_page_view(humanReadableId):
     """Returns the main page of the zim file"""
     zimfile = load_zim_file(humanReadableId)
     try:
-        article, mimetype, ns = zimfile.get_main_page()
-        html = mangle_article(article, mimetype, humanReadableId)
-        return Response(html, mimetype=mimetype)
+        index = zimfile.resolve_redirect(zimfile.header['mainPage'])
+        if index is None:
+            abort(404)
+        return article_response(zimfile, index, humanReadableId)
     except OSError as e:
         html = "<html><body>"
         html += "<p>" + _('Error accessing article.') + "</p>"
@@ -62,11 +187,41 @@ def zim_main_page_view(humanReadableId):
 @blueprint.route('/<humanReadableId>/<namespace>/<path:url>')
 def zim_view(humanReadableId, namespace, url):
     zimfile = load_zim_file(humanReadableId)
-    article, mimetype, ns = zimfile.get_article_by_url(namespace, url)
-    if article is None:
+    entry, index = zimfile.get_entry_by_url(namespace, url)
+    if index is not None:
+        index = zimfile.resolve_redirect(index)
+    if index is None:
         abort(404)
-    html = mangle_article(article, mimetype, humanReadableId)
-    return Response(html, mimetype=mimetype)
+    return article_response(zimfile, index, humanReadableId)
+
+@blueprint.route('/<humanReadableId>/suggest')
+def suggest(humanReadableId):
+    """Returns a JSON list of article titles starting with the term
+    argument, looked up directly in the ZIM file title index.  The
+    limit argument is capped at MAX_SUGGESTIONS."""
+    term = request.args.get('term', '')
+    limit = request.args.get('limit', DEFAULT_SUGGESTIONS, int)
+    if limit <= 0:
+        abort(400)
+    limit = min(limit, MAX_SUGGESTIONS)
+    titles = []
+    if term != '':
+        zimfile = load_zim_file(humanReadableId)
+        entries = zimfile.search_titles(term, limit)
+        # Article titles are usually capitalized, so also try
+        # the term with its first letter capitalized
+        if len(entries) < limit and term[0].islower():
+            entries += zimfile.search_titles(term[0].upper() + term[1:], limit - len(entries))
+        titles = [entry['title'] or entry['url'] for entry in entries]
+    # A top-level array is what jquery autocomplete expects, see gutenberg.autocomplete
+    return Response(response=json.dumps(titles), mimetype="application/json")
+
+@blueprint.route('/debug/cache')
+def cache_stats_view():
+    """Returns the counters of the shared ZIM cluster, article and search
+    result caches as JSON"""
+    return jsonify(clusters=shared_cluster_cache.stats(), articles=article_cache.stats(),
+                   searches=result_cache.stats())
 
 @blueprint.route('/iframe/<humanReadableId>')
 def iframe_main_page_view(humanReadableId):
@@ -88,7 +243,7 @@ def search(humanReadableId):
         page = int(request.args.get('page', 1))
     
         # Load index so we can query it for which fields exist
-        ix = whoosh_open_dir_32_or_64(index_dir)
+        ix = shared_index_registry.get(index_dir)
 
         # Set a higher value for the title field so it is weighted more
         weighting = scoring.BM25F(title_B=1.0)
@@ -102,18 +257,31 @@ def search(humanReadableId):
             else:
                 return 0;
 
-        # Support older whoosh indexes that do not have a reverse_links field
-        if 'reverse_links' in ix.schema.names():
+        # Indexes with a static_rank column are sorted from columns alone:
+        # the image page flag in its high bits, then the score, then the
+        # rest of the static rank for the number of links.  Support older
+        # whoosh indexes that only have a reverse_links field, or neither.
+        # sort_key names the sort order for the result cache
+        if 'static_rank' in ix.schema.names():
+            sortedby = sorting.MultiFacet([ sorting.TranslateFacet(zim_static_rank_image, sorting.FieldFacet("static_rank")),
+                                            sorting.ScoreFacet(),
+                                            sorting.FieldFacet("static_rank"),
+                                           ])
+            sort_key = ('static_rank_image', 'score', 'static_rank')
+        elif 'reverse_links' in ix.schema.names():
             sortedby = sorting.MultiFacet([ sorting.FunctionFacet(image_pages_last),
                                             sorting.ScoreFacet(),
                                             sorting.FieldFacet("reverse_links", reverse=True),
                                            ])
+            sort_key = ('image_pages_last', 'score', 'reverse_links')
         else:
             sortedby = sorting.MultiFacet([ sorting.FunctionFacet(image_pages_last),
                                             sorting.ScoreFacet(),
                                            ])
+            sort_key = ('image_pages_last', 'score')
 
-        (pagination, suggestion) = paginated_search(ix, ["title", "content"], query, page, weighting=weighting, sort_column=sortedby)
+        (pagination, suggestion) = paginated_search(index_dir, ["title", "content"], query, page, weighting=weighting,
+                                                    sort_column=sortedby, sort_key=sort_key)
     else:
         flash(_('Please input keyword(s)'), 'error')
 
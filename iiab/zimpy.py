@@ -1,11 +1,21 @@
+import os
 import re
+import mmap
 import struct
 import string
 import timepro
 import logging
+import time
 import uuid
+import itertools
+import threading
+from array import array
+from collections import OrderedDict
+
+from utils import is32bit
 
 import sys
+import tempfile
 # Import lzma this way so we get the built in version for
 # Python 3.3 or the backported one otherwize. Don't just
 # do a try/catch for import lzma because the older
@@ -22,28 +32,6 @@ else:
         # namespace until we get it resolved upstream
         from backportslzma import lzma
 
-try:
-    # repose.lru does not help much in production
-    # web serving.  It makes a HUGE difference in
-    # pre-processing.  So we don't want to make it
-    # a hard dependency.
-    from repoze.lru import LRUCache
-except ImportError as e:
-    class LRUCache(object):
-        def __init__(self, cache_size):
-            return
-
-        def get(self, key, value=None):
-            return value
-
-        def put(self, key, value):
-            return
-
-        def clear(self):
-            return
-
-from StringIO import StringIO
-
 logger = logging.getLogger(__name__)
 
 HEADER_FORMAT = [
@@ -112,19 +100,43 @@ CLUSTER_FORMAT = [
 # A null byte
 NULL = struct.pack('B', 0)
 
+# Pointer list entries and the leading mimetype of a directory entry
+QWORD = struct.Struct('<Q')
+UINT32 = struct.Struct('<I')
+UINT16 = struct.Struct('<H')
+# Start and end offsets of a blob in a cluster header
+BLOB_RANGE = struct.Struct('<II')
 
-def format_from_rich(rich_format):
-    return "<" + string.join([x[0] for x in rich_format], "")
+# Size and number of the mappings kept when the whole file can not be
+# mapped into the address space at once (32-bit hosts).  Several windows
+# let a lookup move between the pointer lists, directory entries and
+# cluster data without remapping on every step.
+MMAP_WINDOW_SIZE = 16 * 1024 * 1024
+MMAP_WINDOW_COUNT = 4
+
+# Default memory budget of the process-wide cluster cache
+DEFAULT_CLUSTER_CACHE_BYTES = 32 * 1024 * 1024
+
+# Number of decoded directory entries each ZimFile keeps
+DIRENT_CACHE_SIZE = 1024
+
+# Default limits of the process-wide pool of open ZIM files
+DEFAULT_POOL_MAX_OPEN = 16
+DEFAULT_POOL_IDLE_TIMEOUT = 600
+
+# Initial guess for the length of a null terminated string
+STRING_SCAN_SIZE = 1024
 
+# Bytes read at once when decoding a directory entry, enough for the
+# fixed fields, url and title of nearly every entry in one read
+DIRENT_READ_SIZE = 256
 
-@timepro.profile()
-def read_null_terminated(f, encoding='utf-8'):
-    s = ""
-    while True:
-        b = f.read(1)
-        if b == NULL:
-            return s.decode(encoding)
-        s = s + b
+# Bytes read at once when decoding the mime type list
+MIME_LIST_READ_SIZE = 1024
+
+
+def format_from_rich(rich_format):
+    return "<" + string.join([x[0] for x in rich_format], "")
 
 
 def binary_search(f, t, min, max):
@@ -161,12 +173,8 @@ class Format(object):
         return d
 
     @timepro.profile()
-    def unpack_format_from_file(self, f, seek=None):
-        if seek is not None:
-            timepro.start("seek")
-            f.seek(seek)
-            timepro.end("seek")
-        buf = f.read(self.size)
+    def unpack_format_from_reader(self, reader, offset):
+        buf = reader.read(offset, self.size)
         d = self.unpack_format(buf)
         return d
 
@@ -176,9 +184,167 @@ class Format(object):
         return self.unpack_format(buffer, offset)
 
     @timepro.profile()
-    def unpack_from_file(self, f, seek=None):
+    def unpack_from_reader(self, reader, offset):
         """Override this to get more complex behavior"""
-        return self.unpack_format_from_file(f, seek)
+        return self.unpack_format_from_reader(reader, offset)
+
+
+class FileReader(object):
+    """Random access to a ZIM file through seek() and read() on
+    a regular file object.  The file position is shared, so each seek
+    and read pair is done under a lock."""
+
+    def __init__(self, filename):
+        self.f = open(filename, "rb")
+        self.size = os.fstat(self.f.fileno()).st_size
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+    def read(self, offset, size):
+        with self.lock:
+            timepro.start("seek")
+            self.f.seek(offset)
+            timepro.end("seek")
+            return self.f.read(size)
+
+    def view(self, offset, size):
+        """Returns a read-only buffer over size bytes at offset.  A file
+        object can not be shared, so this is a copy."""
+        return buffer(self.read(offset, size))
+
+    def views_are_copies(self):
+        """True if view() copies the bytes onto the heap"""
+        return True
+
+    def unpack(self, compiled, offset):
+        """Unpacks the struct.Struct compiled found at offset"""
+        return compiled.unpack(self.read(offset, compiled.size))
+
+    def read_null_terminated(self, offset, encoding='utf-8'):
+        """Returns the string found at offset along with the offset
+        just past its null terminator"""
+        size = STRING_SCAN_SIZE
+        while True:
+            buf = self.read(offset, size)
+            end = buf.find(NULL)
+            if end != -1:
+                return buf[:end].decode(encoding), offset + end + 1
+            if len(buf) < size:
+                raise IOError("Unterminated string at offset %d" % offset)
+            size *= 2
+
+
+class MmapReader(object):
+    """Random access to a ZIM file through a read-only memory map.
+
+    If window_size is None the whole file is mapped at once.  Otherwise
+    only up to window_count windows of at least window_size bytes are
+    mapped at any time, the least recently used one being replaced as
+    reads require, which keeps multi-GB files from exhausting the address
+    space of 32-bit hosts.
+
+    Reads slice the map without any file position, so they are safe
+    from several threads.  The windows are kept as a tuple of
+    (map, start, end) tuples, most recently used first, which is
+    replaced rather than modified, so a thread always sees consistent
+    windows without taking a lock.  Concurrent updates may lose a
+    window or its place in the order, which only costs a later remap."""
+
+    def __init__(self, filename, window_size=None, window_count=MMAP_WINDOW_COUNT):
+        self.f = open(filename, "rb")
+        self.size = os.fstat(self.f.fileno()).st_size
+        self.windows = ()
+        self.window_count = window_count
+        self.remaps = 0
+        if window_size is None or window_size >= self.size:
+            self.window_size = self.size
+            self.window_count = 1
+            self._map_window(0, self.size)
+        else:
+            # Mappings must begin on an allocation granularity boundary
+            granularity = mmap.ALLOCATIONGRANULARITY
+            self.window_size = max(granularity, window_size - window_size % granularity)
+
+    def close(self):
+        # Cached clusters may still hold views into the map, so it is left
+        # to be unmapped once the last reference to it is gone
+        self.windows = ()
+        self.f.close()
+
+    def _map_window(self, start, length):
+        m = mmap.mmap(self.f.fileno(), length, access=mmap.ACCESS_READ, offset=start)
+        window = (m, start, start + length)
+        self.windows = (window,) + self.windows[:self.window_count - 1]
+        return window
+
+    def _window(self, offset, size):
+        """Returns a map covering offset + size and the position within
+        it of offset, mapping a new window in place of the least recently
+        used one if none does"""
+        size = max(0, min(size, self.size - offset))
+        windows = self.windows
+        for i, (m, start, end) in enumerate(windows):
+            if start <= offset and offset + size <= end:
+                if i:
+                    self.windows = (windows[i],) + windows[:i] + windows[i + 1:]
+                return m, offset - start
+        timepro.start("remap")
+        self.remaps += 1
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        length = min(max(self.window_size, offset + size - start), self.size - start)
+        m, start, end = self._map_window(start, length)
+        timepro.end("remap")
+        return m, offset - start
+
+    def read(self, offset, size):
+        m, pos = self._window(offset, size)
+        return m[pos:pos + size]
+
+    def view(self, offset, size):
+        """Returns a read-only buffer over size bytes at offset which
+        refers to the memory map rather than copying out of it.  With a
+        windowed map this is a copy instead, so cached views do not pin
+        old windows in the address space."""
+        if self.window_size < self.size:
+            return buffer(self.read(offset, size))
+        m, pos = self._window(offset, size)
+        return buffer(m, pos, size)
+
+    def views_are_copies(self):
+        """True if view() copies the bytes onto the heap"""
+        return self.window_size < self.size
+
+    def unpack(self, compiled, offset):
+        """Unpacks the struct.Struct compiled found at offset"""
+        m, pos = self._window(offset, compiled.size)
+        return compiled.unpack_from(m, pos)
+
+    def read_null_terminated(self, offset, encoding='utf-8'):
+        """Returns the string found at offset along with the offset
+        just past its null terminator"""
+        scan = STRING_SCAN_SIZE
+        while True:
+            m, pos = self._window(offset, scan)
+            end = m.find(NULL, pos, pos + scan)
+            if end != -1:
+                return m[pos:end].decode(encoding), offset + end - pos + 1
+            if offset + scan >= self.size:
+                raise IOError("Unterminated string at offset %d" % offset)
+            scan *= 2
+
+
+def open_reader(filename, use_mmap=True):
+    """Returns a reader for filename.  When use_mmap is set the file is
+    memory mapped, as a whole on 64-bit hosts or in sliding windows on
+    32-bit hosts to avoid address space exhaustion on large files."""
+    if not use_mmap:
+        return FileReader(filename)
+    if is32bit():
+        return MmapReader(filename, window_size=MMAP_WINDOW_SIZE)
+    return MmapReader(filename)
 
 
 class HeaderFormat(Format):
@@ -192,165 +358,378 @@ class ClusterFormat(Format):
 
 
 class ClusterCache(object):
-    def __init__(self, cache_size):
-        self.lru = LRUCache(cache_size)
+    """Least recently used cache of ClusterData objects shared by every
+    open ZimFile in the process.  Entries are keyed by (zim uuid, cluster
+    number) and the cache is bounded by the bytes of cluster data held
+    rather than by the number of clusters.
+
+    The cache is shared between threads, so its bookkeeping is done under
+    a lock.  Clusters are loaded outside the lock so that a slow miss does
+    not hold up hits on other clusters."""
+
+    def __init__(self, budget=DEFAULT_CLUSTER_CACHE_BYTES):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
         self.hits = 0
         self.misses = 0
-
-    def get(self, file_buffer, ptr):
-        v = self.lru.get((file_buffer, ptr))
-        if v is not None:
-            self.hits += 1
-            return v
-        v = ClusterData(file_buffer, ptr)
-        self.lru.put((file_buffer, ptr), v)
-        self.misses += 1
-        return v
+        self.evictions = 0
+
+    def get(self, key, load):
+        """Returns the cluster cached under key, calling load() to create
+        and cache it on a miss"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.hits += 1
+                self.entries[key] = entry
+                return entry[0]
+            self.misses += 1
+        cluster = load()
+        with self.lock:
+            # Another thread may have loaded the same cluster meanwhile
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry[0]
+            self.entries[key] = [cluster, 0]
+            self._update(key)
+        return cluster
+
+    def update(self, key):
+        """Recounts the size of the cluster cached under key, which grows
+        as lazily decompressed clusters are read further, and evicts the
+        least recently used clusters until the cache is within budget.
+        The most recently used cluster is never evicted."""
+        with self.lock:
+            self._update(key)
+
+    def _update(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        nbytes = entry[0].nbytes()
+        self.bytes += nbytes - entry[1]
+        entry[1] = nbytes
+        self._evict()
+
+    def _evict(self):
+        while self.bytes > self.budget and len(self.entries) > 1:
+            key, (cluster, nbytes) = self.entries.popitem(last=False)
+            self.bytes -= nbytes
+            self.evictions += 1
+
+    def discard_incomplete(self, reader):
+        """Drops partially decompressed clusters which still need to read
+        from reader, for when it is about to be closed"""
+        with self.lock:
+            for key, (cluster, nbytes) in self.entries.items():
+                if cluster.reader is reader and not cluster.is_complete():
+                    del self.entries[key]
+                    self.bytes -= nbytes
+
+    def discard_zim(self, zim_uuid):
+        """Drops every cluster of the ZIM file with zim_uuid, for when the
+        file has been replaced"""
+        with self.lock:
+            for key, (cluster, nbytes) in self.entries.items():
+                if key[0] == zim_uuid:
+                    del self.entries[key]
+                    self.bytes -= nbytes
+
+    def set_budget(self, budget):
+        """Sets the memory budget in bytes"""
+        with self.lock:
+            self.budget = budget
+            self._evict()
+
+    def stats(self):
+        """Returns a dictionary of the cache counters"""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': self.bytes,
+                'budget': self.budget,
+                'clusters': len(self.entries),
+            }
 
     def clear(self):
         logger.debug("CACHE HITS " + str(self.hits) + " VS MISSES " + str(self.misses))
-        self.lru.clear()
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
 
 
 class ClusterData(object):
+    """The blobs of one cluster.  The cluster data is held as a single
+    immutable buffer, the decompressed string for LZMA clusters or a
+    view into the memory map for uncompressed ones, and blobs can be
+    returned as views into it without copying.
+
+    LZMA clusters are decompressed lazily: the decompressor is kept
+    alive and only run as far as the highest blob requested so far,
+    resuming when a later blob is needed.  Decompression is done under
+    a per-cluster lock, while readers of data already decompressed never
+    wait for it."""
+
     @timepro.profile()
-    def __init__(self, file_buffer, ptr):
-        cluster_info = dict(ClusterFormat().unpack_from_file(file_buffer, ptr))
+    def __init__(self, reader, ptr):
+        cluster_info = dict(ClusterFormat().unpack_from_reader(reader, ptr))
         self.compressed = cluster_info['compressionType'] == 4
 
-        self.file_buf = file_buffer
-        self.uncomp_buf = None
+        self.reader = reader
         self.ptr = ptr
 
-        self.offsets = []
+        self.data = None
+        self.offsets = None
 
         if self.compressed:
-            self._decompress()
+            self.data = ""
+            self.decomp = lzma.LZMADecompressor()
+            self.comp_pos = ptr + 1
+            self.lock = threading.Lock()
+        else:
+            self.decomp = None
 
         self.read_offsets()
 
+        if not self.compressed:
+            # The last offset marks the end of the last blob
+            self.data = reader.view(ptr + 1, self.offsets[-1])
+            self.data_on_heap = reader.views_are_copies()
+            # Everything is in data now, so the reader is not pinned
+            self.reader = None
+        else:
+            self.data_on_heap = True
+
     @timepro.profile()
-    def _decompress(self, chunk_size=32000):
-        """Decompresses the cluster if compression flag was found. Stores
-        uncompressed results internally."""
+    def _decompress(self, size, chunk_size=8192):
+        """Continues decompressing the cluster until at least size bytes
+        of uncompressed data are available or the cluster is complete,
+        going at least twice as far as already decompressed.  Blob views handed out earlier keep referring to the previous,
+        shorter, data string, which is never modified."""
 
-        if not self.compressed:
+        if len(self.data) >= size or self.decomp is None:
             return
 
-        self.file_buf.seek(self.ptr + 1)
+        with self.lock:
+            self._decompress_locked(size, chunk_size)
 
-        # Store uncompressed cluster data for use as uncompressed data
-        self.uncomp_buf = StringIO()
+    def _decompress_locked(self, size, chunk_size):
+        # Another thread may have got far enough while we waited
+        if len(self.data) >= size or self.decomp is None:
+            return
 
-        decomp = lzma.LZMADecompressor()
-        while not decomp.eof:
-            timepro.start("file_buf read")
-            comp_data = self.file_buf.read(chunk_size)
-            timepro.end("file_buf read")
+        # Each extension at least doubles the data, so reading a cluster
+        # blob by blob joins it O(log n) rather than O(n) times
+        size = max(size, 2 * len(self.data))
+        chunks = [self.data]
+        available = len(self.data)
+        while available < size and not self.decomp.eof:
+            timepro.start("reader read")
+            comp_data = self.reader.read(self.comp_pos, chunk_size)
+            timepro.end("reader read")
+            if len(comp_data) == 0:
+                raise IOError("Compressed cluster at %d is truncated" % self.ptr)
+            self.comp_pos += len(comp_data)
 
             timepro.start("decompress")
-            uncomp_data = decomp.decompress(comp_data)
+            uncomp_data = self.decomp.decompress(comp_data)
             timepro.end("decompress")
-
-            timepro.start("write")
-            self.uncomp_buf.write(uncomp_data)
-            timepro.end("write")
-
-        return self.uncomp_buf
-
-    def source_buffer(self):
-        """Returns the buffer to read from, either the file buffer
-        passed or the uncompressed lzma data. Will seek to the
-        beginning of the cluster after the 1 byte compression flag"""
+            chunks.append(uncomp_data)
+            available += len(uncomp_data)
+
+        self.data = string.join(chunks, "")
+        if self.decomp.eof:
+            self.decomp = None
+            # A complete cluster no longer reads, so it does not keep the
+            # reader and its file open
+            self.reader = None
+
+    def decompress_all(self, chunk_size=1024 * 1024):
+        """Decompresses the rest of the cluster at once, joining the data
+        a single time, for callers which want every blob"""
+        self._decompress(sys.maxint, chunk_size)
+
+    def is_complete(self):
+        """True once no more data remains to be decompressed"""
+        return self.decomp is None
+
+    def nbytes(self):
+        """Approximate memory held by this cluster.  Data viewed in the
+        memory map takes no heap, so only its offsets count."""
+        nbytes = self.offsets.itemsize * len(self.offsets)
+        if self.data_on_heap:
+            nbytes += len(self.data)
+        return nbytes
+
+    def read_data(self, offset, size):
+        """Reads size bytes starting offset bytes into the cluster data,
+        which is either the uncompressed lzma data or the file itself
+        just after the 1 byte compression flag"""
 
         if self.compressed:
-            self.uncomp_buf.seek(0)
-            return self.uncomp_buf
+            self._decompress(offset + size)
+            return self.data[offset:offset + size]
+        elif self.data is not None:
+            return self.data[offset:offset + size]
         else:
-            self.file_buf.seek(self.ptr + 1)
-            return self.file_buf
-
-    def unpack_blob_index(self, buf):
-        ptr = struct.unpack('I', buf)[0]
-        return ptr
+            return self.reader.read(self.ptr + 1 + offset, size)
 
     @timepro.profile()
     def read_offsets(self):
-        """Reads the cluster header with the offsets of the blobs"""
+        """Reads the cluster header with the offsets of the blobs.  The
+        first offset points just past the table, so it also gives the
+        table size, and the whole table is then parsed in one go."""
 
-        src_buf = self.source_buffer()
+        offset0 = UINT32.unpack(self.read_data(0, 4))[0]
+        self.offsets = array('I')
+        self.offsets.fromstring(self.read_data(0, offset0))
+        if sys.byteorder == 'big':
+            self.offsets.byteswap()
 
-        raw = src_buf.read(4)
-        offset0 = self.unpack_blob_index(raw)
-        self.offsets.append(offset0)
-        nblob = offset0 / 4
+        return self.offsets
 
-        for idx in xrange(nblob-1):
-            raw = src_buf.read(4)
-            offset = self.unpack_blob_index(raw)
-            self.offsets.append(offset)
+    def blob_range(self, blob_index):
+        """Returns the start and end of a blob within the cluster data"""
 
-        return self.offsets
+        if blob_index >= len(self.offsets) - 1:
+            raise IOError("Blob index exceeds number of blobs available: %s" % blob_index)
+
+        start, end = self.offsets[blob_index], self.offsets[blob_index + 1]
+        if self.compressed:
+            self._decompress(end)
+        return start, end
 
     @timepro.profile()
     def read_blob(self, blob_index):
         """Reads a blob from the cluster"""
 
-        if blob_index >= len(self.offsets) - 1:
-            raise IOError("Blob index exceeds number of blobs available: %s" % blob_index)
+        start, end = self.blob_range(blob_index)
+        return self.data[start:end]
 
-        src_buf = self.source_buffer()
+    def read_blob_view(self, blob_index):
+        """Returns a read-only buffer over a blob without copying it"""
 
-        blob_size = self.offsets[blob_index+1] - self.offsets[blob_index]
+        start, end = self.blob_range(blob_index)
+        return buffer(self.data, start, end - start)
 
-        # For uncompressed data, seek from beginning of file
-        # Otherwise seek the compressed data with just and offset
-        if not self.compressed:
-            seek_beg = self.ptr + 1
-        else:
-            seek_beg = 0
-        src_buf.seek(seek_beg + self.offsets[blob_index])
 
-        blob_data = src_buf.read(blob_size)
+class Dirent(object):
+    """A decoded directory entry.  Article entries have clusterNumber and
+    blobNumber set, redirect entries have redirectIndex set instead.
 
-        return blob_data
+    Fields are read as attributes or, for compatibility with code that
+    used the plain dictionaries zimpy returned before, with entry['url'],
+    entry.keys(), entry.items() and entry.get().  Entries may be shared
+    through the dirent cache, so they must not be modified."""
 
-class ArticleEntryFormat(Format):
-    def __init__(self):
-        super(ArticleEntryFormat, self).__init__(ARTICLE_ENTRY_FORMAT)
+    __slots__ = ('index', 'mimetype', 'parameterLen', 'namespace', 'revision',
+                 'clusterNumber', 'blobNumber', 'redirectIndex',
+                 'url', 'title', 'parameter')
 
-    def unpack(self, buffer, offset=0):
-        raise Exception("Unimplemented")
+    ARTICLE = struct.Struct(format_from_rich(ARTICLE_ENTRY_FORMAT))
+    REDIRECT = struct.Struct(format_from_rich(REDIRECT_ENTRY_FORMAT))
 
-    def unpack_from_file(self, f, seek=None):
-        d = super(ArticleEntryFormat, self).unpack_from_file(f, seek)
-        url = read_null_terminated(f)
-        title = read_null_terminated(f)
-        parameter = f.read(dict(d)['parameterLen'])
-        d.extend([('url', url),
-                  ('title', title),
-                  ('parameter', parameter)]
-                 )
+    @classmethod
+    @timepro.profile()
+    def from_reader(cls, reader, offset, index=None):
+        """Decodes the directory entry found at offset"""
+        d = cls()
+        size = DIRENT_READ_SIZE
+        buf = reader.read(offset, size)
+        if UINT16.unpack_from(buf)[0] == 0xffff:  # Then redirect
+            (d.mimetype, d.parameterLen, d.namespace, d.revision,
+             d.redirectIndex) = cls.REDIRECT.unpack_from(buf)
+            pos = cls.REDIRECT.size
+        else:
+            (d.mimetype, d.parameterLen, d.namespace, d.revision,
+             d.clusterNumber, d.blobNumber) = cls.ARTICLE.unpack_from(buf)
+            pos = cls.ARTICLE.size
+
+        # Find both strings and the parameter data in a single read,
+        # only reading again for the rare entry longer than that
+        while True:
+            url_end = buf.find(NULL, pos)
+            title_end = buf.find(NULL, url_end + 1) if url_end != -1 else -1
+            if title_end != -1 and title_end + 1 + d.parameterLen <= len(buf):
+                break
+            if len(buf) < size:
+                raise IOError("Directory entry at offset %d is truncated" % offset)
+            size *= 4
+            buf = reader.read(offset, size)
+
+        d.url = buf[pos:url_end].decode('utf-8')
+        d.title = buf[url_end + 1:title_end].decode('utf-8')
+        d.parameter = buf[title_end + 1:title_end + 1 + d.parameterLen]
+        d.index = index
         return d
 
+    def is_redirect(self):
+        return self.mimetype == 0xffff
 
-class RedirectEntryFormat(Format):
-    def __init__(self):
-        super(RedirectEntryFormat, self).__init__(REDIRECT_ENTRY_FORMAT)
+    @property
+    def fullUrl(self):
+        return full_url(self.namespace, self.url)
 
-    def unpack(self, buffer, offset=0):
-        raise Exception("Unimplemented")
+    def keys(self):
+        return [k for k in self.__slots__ if hasattr(self, k)] + ['fullUrl']
 
-    def unpack_from_file(self, f, seek=None):
-        d = super(RedirectEntryFormat, self).unpack_from_file(f, seek)
-        url = read_null_terminated(f)
-        title = read_null_terminated(f)
-        parameter = f.read(dict(d)['parameterLen'])
-        d.extend([('url', url),
-                  ('title', title),
-                  ('parameter', parameter)]
-                 )
-        return d
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def __repr__(self):
+        return "Dirent(%r)" % dict(self.items())
+
+
+class DirentCache(object):
+    """Bounded cache of decoded directory entries keyed by index.
+
+    Rather than tracking exact recency, entries live in two dictionaries:
+    new entries go into the current generation, and once it holds half
+    the cache size it replaces the previous generation, which is dropped.
+    Hits on the previous generation are promoted.  This approximates LRU
+    at the cost of plain dictionary operations.
+
+    It needs no lock: each dictionary operation is atomic, and the worst
+    a race between threads can do is drop entries, which are re-read."""
+
+    def __init__(self, cache_size):
+        self.generation_size = max(1, cache_size / 2)
+        self.current = {}
+        self.previous = {}
+
+    def get(self, key):
+        v = self.current.get(key)
+        if v is None:
+            v = self.previous.get(key)
+            if v is not None:
+                self.put(key, v)
+        return v
+
+    def put(self, key, value):
+        self.current[key] = value
+        if len(self.current) >= self.generation_size:
+            self.previous = self.current
+            self.current = {}
+
+    def clear(self):
+        self.current = {}
+        self.previous = {}
 
 
 class MimeTypeListFormat(Format):
@@ -360,31 +739,304 @@ class MimeTypeListFormat(Format):
     def unpack(self, buffer, offset=0):
         raise Exception("Unimplemented")
 
-    def unpack_from_file(self, f, seek=None):
-        if seek is not None:
-            f.seek(seek)
-        mimetypes = []
+    def unpack_from_reader(self, reader, offset):
+        # The list is terminated by an empty string, so it ends at the
+        # first null byte that directly follows another or starts it
+        size = MIME_LIST_READ_SIZE
         while True:
-            s = read_null_terminated(f)
-            if s == "":
-                return mimetypes
-            mimetypes.append(s)
+            buf = reader.read(offset, size)
+            if buf[:1] == NULL:
+                return []
+            end = buf.find(NULL + NULL)
+            if end != -1:
+                return [s.decode('utf-8') for s in buf[:end].split(NULL)]
+            if len(buf) < size:
+                raise IOError("Mime type list at offset %d is truncated" % offset)
+            size *= 4
+
+
+def read_uint32_array(f, count):
+    """Reads count little endian 32 bit unsigned integers from f"""
+    values = array('I')
+    values.fromfile(f, count)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def write_uint32_array(f, values):
+    """Writes an array('I') to f as little endian integers"""
+    if sys.byteorder == 'big':
+        values = array('I', values)
+        values.byteswap()
+    values.tofile(f)
+
+
+class Sidecar(object):
+    """Base class of the tables derived from a ZIM file which are saved
+    to a sidecar file next to it.  The file starts with HEADER, which
+    holds MAGIC, the UUID of the ZIM file and the fields returned by
+    header_fields(), followed by the body."""
+
+    MAGIC = None
+    HEADER = None
+    DESCRIPTION = None
+
+    @classmethod
+    def load(cls, filename, zim_uuid=None):
+        """Loads a sidecar file.  Returns None if the file was written
+        for a ZIM file other than the one with zim_uuid."""
+        with open(filename, "rb") as f:
+            fields = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if fields[0] != cls.MAGIC:
+                raise IOError("%s is not a ZIM %s" % (filename, cls.DESCRIPTION))
+            if zim_uuid is not None and fields[1] != zim_uuid.bytes:
+                return None
+            return cls.read_body(f, filename, *fields[2:])
+
+    def save(self, filename, zim_uuid):
+        """Writes the sidecar file for the ZIM file with zim_uuid.  It is
+        written to a temporary file renamed into place once complete, so
+        that a server never loads a partly written file."""
+        fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(filename) + ".",
+                                        dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.HEADER.pack(self.MAGIC, zim_uuid.bytes, *self.header_fields()))
+                self.write_body(f)
+            # mkstemp creates files only their owner can read
+            os.chmod(tmp_file, 0644)
+            os.rename(tmp_file, filename)
+        except:
+            os.unlink(tmp_file)
+            raise
+
+    @classmethod
+    def read_body(cls, f, filename, *fields):
+        raise NotImplementedError
+
+    def header_fields(self):
+        raise NotImplementedError
+
+    def write_body(self, f):
+        raise NotImplementedError
+
+
+class UrlIndex(Sidecar):
+    """The sorted namespace + URL keys of every directory entry of a ZIM
+    file held in memory, so URL lookups can bisect without reading any
+    directory entries from disk.
+
+    The keys are stored UTF-8 encoded as "<namespace>/<url>" in a single
+    contiguous string, and entry i spans keys[offsets[i]:offsets[i+1]].
+    The index can be saved to and loaded from a sidecar file."""
+
+    MAGIC = "ZIMURLX1"
+    HEADER = struct.Struct('<8s16sQQ')
+    DESCRIPTION = "URL index"
+
+    def __init__(self, keys, offsets):
+        self.keys = keys
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def key(self, index):
+        """Returns the encoded key of the entry at index"""
+        return self.keys[self.offsets[index]:self.offsets[index + 1]]
+
+    def find(self, namespace, url):
+        """Returns the index of the entry for namespace and url, or None"""
+        key = full_url(namespace, url)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        lo = 0
+        hi = len(self.offsets) - 1
+        keys = self.keys
+        offsets = self.offsets
+        while lo < hi:
+            m = (lo + hi) / 2
+            if keys[offsets[m]:offsets[m + 1]] < key:
+                lo = m + 1
+            else:
+                hi = m
+        if lo < len(self) and self.key(lo) == key:
+            return lo
+        return None
+
+    @classmethod
+    @timepro.profile()
+    def build(cls, zim_file):
+        """Builds the index by reading the namespace and url of every
+        directory entry, without decoding the rest of the entry"""
+        reader = zim_file.reader
+        article_size = Dirent.ARTICLE.size
+        redirect_size = Dirent.REDIRECT.size
+        count = zim_file.header['articleCount']
+        keys = []
+        offsets = array('I', [0])
+        end = 0
+        for i in xrange(count):
+            ptr = zim_file.read_url_pointer(i)
+            mimetype, = reader.unpack(UINT16, ptr)
+            namespace = reader.read(ptr + 3, 1)
+            if mimetype == 0xffff:
+                url, pos = reader.read_null_terminated(ptr + redirect_size)
+            else:
+                url, pos = reader.read_null_terminated(ptr + article_size)
+            key = namespace + '/' + url.encode('utf-8')
+            end += len(key)
+            if end > 0xffffffff:
+                raise ValueError("URL index for %s exceeds 4GB" % zim_file.filename)
+            keys.append(key)
+            offsets.append(end)
+        return cls(string.join(keys, ""), offsets)
+
+    @classmethod
+    def read_body(cls, f, filename, count, keys_len):
+        offsets = read_uint32_array(f, count + 1)
+        keys = f.read(keys_len)
+        if len(keys) != keys_len or offsets[-1] != keys_len:
+            raise EOFError("%s is truncated" % filename)
+        return cls(keys, offsets)
+
+    def header_fields(self):
+        return len(self), len(self.keys)
+
+    def write_body(self, f):
+        write_uint32_array(f, self.offsets)
+        f.write(self.keys)
+
+
+class RedirectMap(Sidecar):
+    """The final target index of every directory entry of a ZIM file,
+    with redirect chains collapsed, so that following a redirect takes a
+    single array lookup.  Entries which are not redirects map to
+    themselves, and redirects which are broken or part of a cycle map to
+    NO_TARGET.  The map can be saved to and loaded from a sidecar file."""
+
+    MAGIC = "ZIMREDR1"
+    HEADER = struct.Struct('<8s16sQ')
+    DESCRIPTION = "redirect map"
+    NO_TARGET = 0xffffffff
+
+    def __init__(self, targets):
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.targets)
+
+    def resolve(self, index):
+        """Returns the index of the article index finally redirects to,
+        index itself if it is not a redirect, or None if the redirect
+        is broken"""
+        target = self.targets[index]
+        if target == self.NO_TARGET:
+            return None
+        return target
+
+    @classmethod
+    @timepro.profile()
+    def build(cls, zim_file):
+        """Builds the map by reading the mimetype and redirect index of
+        every directory entry, without decoding the rest of the entry"""
+        reader = zim_file.reader
+        count = zim_file.header['articleCount']
+        no_target = cls.NO_TARGET
+        targets = array('I', xrange(count))
+        # 0 for unresolved redirects, 1 while on the chain being
+        # followed, 2 once the final target is known
+        state = array('B', [2]) * count
+        for i in xrange(count):
+            ptr = zim_file.read_url_pointer(i)
+            mimetype, = reader.unpack(UINT16, ptr)
+            if mimetype == 0xffff:
+                target, = reader.unpack(UINT32, ptr + 8)
+                if target >= count:
+                    target = no_target
+                targets[i] = target
+                state[i] = 0
+
+        for i in xrange(count):
+            if state[i] != 0:
+                continue
+            chain = []
+            j = i
+            while True:
+                state[j] = 1
+                chain.append(j)
+                j = targets[j]
+                if j == no_target or state[j] != 0:
+                    break
+            if j == no_target or state[j] == 1:
+                final = no_target
+                logger.warning("Broken or circular redirect at index %d in %s" % (i, zim_file.filename))
+            else:
+                final = targets[j]
+            for j in chain:
+                targets[j] = final
+                state[j] = 2
+        return cls(targets)
+
+    @classmethod
+    def read_body(cls, f, filename, count):
+        return cls(read_uint32_array(f, count))
+
+    def header_fields(self):
+        return len(self),
+
+    def write_body(self, f):
+        write_uint32_array(f, self.targets)
+
+
+# The cluster cache shared by every ZimFile in this process
+shared_cluster_cache = ClusterCache()
+
+
+def url_index_filename(zim_filename):
+    """Returns the sidecar file name used for the URL index of a ZIM file"""
+    return zim_filename + ".urlidx"
+
+
+def redirect_map_filename(zim_filename):
+    """Returns the sidecar file name used for the redirect map of a ZIM file"""
+    return zim_filename + ".redirects"
 
 
 class ZimFile(object):
-    def __init__(self, filename, cache_size=4):
+    def __init__(self, filename, use_mmap=True, url_index=False, redirect_map=False,
+                 dirent_cache_size=DIRENT_CACHE_SIZE, cluster_cache=None):
+        """Opens a ZIM file.  With use_mmap set (the default) all reads
+        are served from a memory map of the file rather than through
+        seek() and read() on a file object.  With url_index or
+        redirect_map set the URL index or redirect map is loaded, or
+        built, at open time.  Clusters are
+        cached in the process-wide shared_cluster_cache unless another
+        ClusterCache is given."""
         self.filename = filename
-        self.redirectEntryFormat = RedirectEntryFormat()
-        self.articleEntryFormat = ArticleEntryFormat()
         self.clusterFormat = ClusterFormat()
-        self.f = open(filename, "r")
-        self.header = dict(HeaderFormat().unpack_from_file(self.f))
-        self.mimeTypeList = MimeTypeListFormat().unpack_from_file(self.f, self.header['mimeListPos'])
-        self.clusterCache = ClusterCache(cache_size=cache_size)
+        self.reader = open_reader(filename, use_mmap)
+        self.mtime = os.path.getmtime(filename)
+        self.header = dict(HeaderFormat().unpack_from_reader(self.reader, 0))
+        self.mimeTypeList = MimeTypeListFormat().unpack_from_reader(self.reader, self.header['mimeListPos'])
+        self.uuid = self.get_uuid()
+        if cluster_cache is None:
+            cluster_cache = shared_cluster_cache
+        self.clusterCache = cluster_cache
+        self.direntCache = DirentCache(dirent_cache_size)
+        self.namespaceRanges = self.find_namespace_ranges()
+        self.urlIndex = None
+        if url_index:
+            self.load_url_index()
+        self.redirectMap = None
+        if redirect_map:
+            self.load_redirect_map()
 
     def close(self):
-        self.clusterCache.clear()
-        self.f.close()
+        self.clusterCache.discard_incomplete(self.reader)
+        self.direntCache.clear()
+        self.reader.close()
 
     def get_uuid(self):
         """Returns the UUID for this ZIM file"""
@@ -403,66 +1055,228 @@ class ZimFile(object):
         s = str(u).split("-")
         return s[0] + "-" + s[1] + "-" + s[2] + "-" + s[2] + "-" + s[3] + s[4]
 
+    def read_namespace(self, index):
+        """Returns only the namespace of the entry at index"""
+        # Namespace is the single byte following mimetype and parameterLen
+        return self.reader.read(self.read_url_pointer(index) + 3, 1)
+
     @timepro.profile()
-    def read_directory_entry(self, offset):
+    def find_namespace_ranges(self):
+        """Returns an OrderedDict mapping each namespace to the (start, stop)
+        range of its entry indexes.  Entries are sorted by namespace first,
+        so each boundary is found by a binary search reading one byte per
+        step."""
+        ranges = OrderedDict()
+        count = self.header['articleCount']
+        start = 0
+        while start < count:
+            namespace = self.read_namespace(start)
+            lo, hi = start + 1, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.read_namespace(mid) <= namespace:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            ranges[namespace] = (start, lo)
+            start = lo
+        return ranges
+
+    def namespace_range(self, namespace):
+        """Returns the (start, stop) range of entry indexes in a namespace,
+        empty if it has no entries"""
+        return self.namespaceRanges.get(namespace, (0, 0))
+
+    def namespace_count(self, namespace):
+        """Returns the number of entries in a namespace"""
+        start, stop = self.namespace_range(namespace)
+        return stop - start
+
+    def load_url_index(self, filename=None, build=True):
+        """Loads the URL index from its sidecar file, or builds it if the
+        sidecar is missing or belongs to another ZIM file.  Once loaded,
+        URL lookups bisect in memory.  With build unset a missing or
+        unusable sidecar leaves the file without an index, and None is
+        returned."""
+        if filename is None:
+            filename = url_index_filename(self.filename)
+        self.urlIndex = self._load_sidecar(UrlIndex, filename, build)
+        return self.urlIndex
+
+    def load_redirect_map(self, filename=None, build=True):
+        """Loads the redirect map from its sidecar file, or builds it if
+        the sidecar is missing or belongs to another ZIM file.  Once
+        loaded, redirects resolve with a single array lookup.  With build
+        unset a missing or unusable sidecar leaves the file without a
+        map, and None is returned."""
+        if filename is None:
+            filename = redirect_map_filename(self.filename)
+        self.redirectMap = self._load_sidecar(RedirectMap, filename, build)
+        return self.redirectMap
+
+    def _load_sidecar(self, cls, filename, build):
+        sidecar = None
+        if os.path.exists(filename):
+            try:
+                sidecar = cls.load(filename, self.get_uuid())
+            except (IOError, EOFError, struct.error, ValueError), e:
+                logger.warning("Ignoring unreadable %s %s: %s" % (cls.DESCRIPTION, filename, e))
+            else:
+                if sidecar is None:
+                    logger.warning("Ignoring %s %s made for another ZIM file" % (cls.DESCRIPTION, filename))
+                elif len(sidecar) != self.header['articleCount']:
+                    logger.warning("Ignoring %s %s with %d of %d entries" %
+                                   (cls.DESCRIPTION, filename, len(sidecar), self.header['articleCount']))
+                    sidecar = None
+        if sidecar is None and build:
+            sidecar = cls.build(self)
+        return sidecar
+
+    def resolve_redirect(self, index):
+        """Returns the index of the entry that the entry at index finally
+        redirects to, index itself if it is not a redirect, or None for
+        a broken or circular redirect"""
+        if index >= self.header['articleCount']:
+            return None
+        if self.redirectMap is not None:
+            return self.redirectMap.resolve(index)
+        start = index
+        seen = set()
+        while True:
+            entry = self.read_directory_entry_by_index(index)
+            if not entry.is_redirect():
+                return index
+            seen.add(index)
+            index = entry.redirectIndex
+            if index in seen or index >= self.header['articleCount']:
+                logger.warning("Broken or circular redirect at index %d in %s" % (start, self.filename))
+                return None
+
+    def read_directory_entry(self, offset, index=None):
         """May return either a Redirect or Article entry depending on flag"""
-        timepro.start("seek")
-        self.f.seek(offset)
-        timepro.end("seek")
-        timepro.start("read(2)")
-        buf = self.f.read(2)
-        timepro.end("read(2)")
-        fields = struct.unpack('H', buf)
-        if fields[0] == 0xffff:  # Then redirect
-            return dict(self.redirectEntryFormat.unpack_from_file(self.f, offset))
-        else:
-            return dict(self.articleEntryFormat.unpack_from_file(self.f, offset))
+        return Dirent.from_reader(self.reader, offset, index)
 
     @timepro.profile()
     def read_url_pointer(self, index):
-        self.f.seek(self.header['urlPtrPos'] + 8 * index)
-        buf = self.f.read(8)
-        fields = struct.unpack('Q', buf)
+        fields = self.reader.unpack(QWORD, self.header['urlPtrPos'] + 8 * index)
         return fields[0]
 
     def read_title_pointer(self, index):
-        self.f.seek(self.header['titlePtrPos'] + 4 * index)
-        buf = self.f.read(4)
-        fields = struct.unpack('L', buf)
+        """Returns the URL index of the entry at index in title order"""
+        fields = self.reader.unpack(UINT32, self.header['titlePtrPos'] + 4 * index)
         return fields[0]
 
     @timepro.profile()
     def read_cluster_pointer(self, index):
         """Returns a pointer to the cluster"""
 
-        self.f.seek(self.header['clusterPtrPos'] + 8 * index)
-        buf = self.f.read(8)
-        fields = struct.unpack('Q', buf)
+        fields = self.reader.unpack(QWORD, self.header['clusterPtrPos'] + 8 * index)
         return fields[0]
 
     @timepro.profile()
     def read_directory_entry_by_index(self, index):
-        ptr = self.read_url_pointer(index)
-        d = self.read_directory_entry(ptr)
-        d['index'] = index
+        d = self.direntCache.get(index)
+        if d is None:
+            ptr = self.read_url_pointer(index)
+            d = self.read_directory_entry(ptr, index)
+            self.direntCache.put(index, d)
         return d
 
+    @timepro.profile()
+    def read_directory_entry_by_title_index(self, index):
+        return self.read_directory_entry_by_index(self.read_title_pointer(index))
+
+    @timepro.profile()
+    def search_titles(self, prefix, limit=10, namespace='A'):
+        """Returns up to limit directory entries from namespace whose
+        title starts with prefix, in title order.  Bisects the title
+        pointer list so only a few dirents are read per call."""
+        prefix = unicode(prefix)
+
+        def title_key(entry):
+            # An empty title means the title is the same as the url
+            return entry['namespace'], entry['title'] or entry['url']
+
+        target = (namespace, prefix)
+        lo = 0
+        hi = self.header['articleCount']
+        while lo < hi:
+            m = (lo + hi) / 2
+            if title_key(self.read_directory_entry_by_title_index(m)) < target:
+                lo = m + 1
+            else:
+                hi = m
+
+        entries = []
+        for i in xrange(lo, self.header['articleCount']):
+            if len(entries) >= limit:
+                break
+            entry = self.read_directory_entry_by_title_index(i)
+            ns, title = title_key(entry)
+            if ns != namespace or not title.startswith(prefix):
+                break
+            entries.append(entry)
+        return entries
+
+    def read_cluster(self, cluster_index):
+        """Returns the ClusterData for a cluster, bypassing the cache"""
+        return ClusterData(self.reader, self.read_cluster_pointer(cluster_index))
+
     @timepro.profile()
     def read_blob(self, cluster_index, blob_index):
+        key = (self.uuid, cluster_index)
+        cluster_data = self.clusterCache.get(key, lambda: self.read_cluster(cluster_index))
+        blob = cluster_data.read_blob(blob_index)
+        self.clusterCache.update(key)
+        return blob
+
+    @timepro.profile()
+    def read_blob_view(self, cluster_index, blob_index):
+        """Like read_blob, but returns a read-only buffer over the blob
+        instead of copying it into a string"""
+        key = (self.uuid, cluster_index)
+        cluster_data = self.clusterCache.get(key, lambda: self.read_cluster(cluster_index))
+        blob = cluster_data.read_blob_view(blob_index)
+        self.clusterCache.update(key)
+        return blob
+
+    @timepro.profile()
+    def open_blob(self, cluster_index, blob_index):
+        """Returns the size of a blob and a function read(offset, size)
+        returning part of it, for serving pieces of large blobs.  Blobs of
+        uncompressed clusters are read straight from the file, using only
+        the two offsets needed from the cluster header, so nothing outside
+        the parts requested is read or cached.  Blobs of compressed
+        clusters are decompressed through the cluster cache."""
         ptr = self.read_cluster_pointer(cluster_index)
-        cluster_data = self.clusterCache.get(self.f, ptr)
-        return cluster_data.read_blob(blob_index)
+        cluster_info = dict(self.clusterFormat.unpack_from_reader(self.reader, ptr))
+        if cluster_info['compressionType'] == 4:
+            view = self.read_blob_view(cluster_index, blob_index)
+            return len(view), lambda offset, size: view[offset:offset + size]
+
+        offset0, = self.reader.unpack(UINT32, ptr + 1)
+        if blob_index >= offset0 / 4 - 1:
+            raise IOError("Blob index exceeds number of blobs available: %s" % blob_index)
+        start, end = self.reader.unpack(BLOB_RANGE, ptr + 1 + 4 * blob_index)
+        base = ptr + 1 + start
+        return end - start, lambda offset, size: self.reader.read(base + offset, size)
 
     @timepro.profile()
-    def get_article_by_index(self, index, follow_redirect=True):
+    def get_article_by_index(self, index, follow_redirect=True, view=False):
+        """Returns the article data, mimetype and namespace.  With view
+        set the data is a read-only buffer rather than a string."""
         entry = self.read_directory_entry_by_index(index)
-        if 'redirectIndex' in entry.keys():
-            if follow_redirect:
-                logger.debug("REDIRECT TO " + str(entry['redirectIndex']))
-                return self.get_article_by_index(entry['redirectIndex'], follow_redirect)
-            else:
+        if entry.is_redirect():
+            if not follow_redirect:
                 return None, entry['redirectIndex'], entry['namespace']
-        data = self.read_blob(entry['clusterNumber'], entry['blobNumber'])
+            target = self.resolve_redirect(index)
+            if target is None:
+                return None, None, None
+            entry = self.read_directory_entry_by_index(target)
+        if view:
+            data = self.read_blob_view(entry['clusterNumber'], entry['blobNumber'])
+        else:
+            data = self.read_blob(entry['clusterNumber'], entry['blobNumber'])
         mime = self.mimeTypeList[entry['mimetype']]
         namespace = entry['namespace']
         return data, mime, namespace
@@ -477,56 +1291,127 @@ class ZimFile(object):
 
     @timepro.profile()
     def get_entry_by_url(self, namespace, url):
-        nsurl = full_url(namespace, url)
+        if self.urlIndex is not None:
+            m = self.urlIndex.find(namespace, url)
+        else:
+            start, stop = self.namespace_range(namespace)
 
-        def check(idx):
-            entry = self.read_directory_entry_by_index(idx)
-            return full_url(entry['namespace'], entry['url'])
+            def check(idx):
+                return self.read_directory_entry_by_index(idx)['url']
 
-        m = binary_search(check, nsurl, 0, self.header['articleCount'])
+            m = binary_search(check, url, start, stop - 1)
         if m is None:
             return None, None
         entry = self.read_directory_entry_by_index(m)
         return entry, m
 
-    def get_article_by_url(self, namespace, url, follow_redirect=True):
+    def get_article_by_url(self, namespace, url, follow_redirect=True, view=False):
         entry, idx = self.get_entry_by_url(namespace, url)
         if idx is None:
             return None, None, None
-        return self.get_article_by_index(idx, follow_redirect=follow_redirect)
+        return self.get_article_by_index(idx, follow_redirect=follow_redirect, view=view)
 
-    def get_main_page(self):
+    def get_main_page(self, view=False):
         main_index = self.header['mainPage']
-        return self.get_article_by_index(main_index)
+        return self.get_article_by_index(main_index, view=view)
 
     @timepro.profile()
     def metadata(self):
         metadata = {}
-        for i in xrange(self.header['articleCount'] - 1, -1, -1):
-            entry = self.read_directory_entry_by_index(i)
-            if entry['namespace'] == 'M':
-                m_name = entry['url']
-                # Lower case first letter to match kiwix-library names convention
-                m_name = re.sub(r'^([A-Z])', lambda pat: pat.group(1).lower(), m_name)
-                metadata[m_name] = self.get_article_by_index(i)[0]
-            else:
-                break
+        for entry in self.articles('M'):
+            m_name = entry['url']
+            # Lower case first letter to match kiwix-library names convention
+            m_name = re.sub(r'^([A-Z])', lambda pat: pat.group(1).lower(), m_name)
+            metadata[m_name] = self.get_article_by_index(entry.index)[0]
 
         return metadata
 
-    def articles(self):
-        """Generator which iterates through all articles"""
-        for i in xrange(self.header['articleCount']):
-            entry = self.read_directory_entry_by_index(i)
-            entry['fullUrl'] = full_url(entry['namespace'], entry['url'])
-            yield entry
+    def articles(self, namespace=None):
+        """Generator which iterates through all articles, or only those in
+        one namespace"""
+        if namespace is None:
+            start, stop = 0, self.header['articleCount']
+        else:
+            start, stop = self.namespace_range(namespace)
+        # Bypass the dirent cache, a full scan would only flush it
+        for i in xrange(start, stop):
+            yield self.read_directory_entry(self.read_url_pointer(i), i)
+
+    @timepro.profile()
+    def cluster_ordered_indexes(self, namespaces=None, mimetypes=None):
+        """Returns an array of the indexes of all articles, redirects
+        excluded, whose namespace is in namespaces and whose mimetype name
+        is in mimetypes (None selects all), ordered by cluster number.
+        Uses a counting sort over compact arrays rather than a list of
+        tuples, so memory stays at a few bytes per article."""
+        count = self.header['articleCount']
+        cluster_count = self.header['clusterCount']
+        if mimetypes is not None:
+            mime_indexes = set(n for n, m in enumerate(self.mimeTypeList) if m in mimetypes)
+        if namespaces is None:
+            entries = self.articles()
+        else:
+            entries = itertools.chain(*[self.articles(ns) for ns in sorted(set(namespaces))])
+
+        # First pass records the cluster of each selected article,
+        # with unselected ones marked as belonging to no cluster
+        no_cluster = 0xffffffff
+        clusters = array('I', [no_cluster]) * count
+        starts = array('I', [0]) * (cluster_count + 1)
+        for entry in entries:
+            if entry.is_redirect():
+                continue
+            if mimetypes is not None and entry.mimetype not in mime_indexes:
+                continue
+            clusters[entry.index] = entry.clusterNumber
+            starts[entry.clusterNumber + 1] += 1
+
+        for c in xrange(cluster_count):
+            starts[c + 1] += starts[c]
+
+        indexes = array('I', [0]) * starts[cluster_count]
+        for i in xrange(count):
+            c = clusters[i]
+            if c != no_cluster:
+                indexes[starts[c]] = i
+                starts[c] += 1
+        return indexes
+
+    def iter_articles_with_content(self, namespaces=None, mimetypes=None, indexes=None):
+        """Generator yielding (dirent, blob) pairs for all articles selected
+        by namespaces and mimetypes as in cluster_ordered_indexes(), or for
+        the indexes it returned if given.  Articles are visited in cluster
+        and blob order, so each cluster is decompressed exactly once and
+        only one cluster is held in memory at a time, without going
+        through the cluster cache."""
+        if indexes is None:
+            indexes = self.cluster_ordered_indexes(namespaces, mimetypes)
+
+        group = []
+        for i in indexes:
+            entry = self.read_directory_entry(self.read_url_pointer(i), i)
+            if group and group[0].clusterNumber != entry.clusterNumber:
+                for item in self._iter_cluster_group(group):
+                    yield item
+                group = []
+            group.append(entry)
+        if group:
+            for item in self._iter_cluster_group(group):
+                yield item
+
+    def _iter_cluster_group(self, entries):
+        """Yields the entries, all from one cluster, with their blobs"""
+        entries.sort(key=lambda e: e.blobNumber)
+        cluster = self.read_cluster(entries[0].clusterNumber)
+        cluster.decompress_all()
+        for entry in entries:
+            yield entry, cluster.read_blob(entry.blobNumber)
 
     def validate(self):
         """This is a mostly a self-test, but will validate various assumptions"""
         # Test that URLs are properly ordered
         last = None
-        for i in xrange(self.header['articleCount']):
-            entry = self.read_directory_entry_by_index(i)
+        for entry in self.articles():
             assert entry is not None
             nsurl = full_url(entry['namespace'], entry['url'])
             if last is not None:
@@ -560,7 +1445,91 @@ class ZimFile(object):
     def list_articles_by_url(self):
         """Mostly for testing"""
         s = ""
-        for i in xrange(self.header['articleCount']):
-            entry = self.read_directory_entry_by_index(i)
+        for entry in self.articles():
             s += full_url(entry['namespace'], entry['url']) + "\n"
         return s
+
+
+class ZimFilePool(object):
+    """Open ZimFile objects shared by every request of the process, keyed
+    by file name, so that the header, mime list, namespace ranges and
+    caches of a ZIM file outlive a single request.
+
+    At most max_open files are kept open, evicting the least recently
+    used, and files unused for idle_timeout seconds are dropped.  A file
+    whose modification time or size has changed since it was opened is
+    reopened.  Evicted files are not closed, as other threads may still be
+    reading from them, but their clusters are dropped from the cluster
+    cache so that they are released once the last request using them
+    is done.
+
+    The URL index and redirect map sidecars written by
+    scripts/zim_url_index.py are loaded when they exist and match the
+    file, but are never built while serving."""
+
+    def __init__(self, max_open=DEFAULT_POOL_MAX_OPEN, idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # file name -> [zim file, (mtime, size), last used]
+        self.entries = OrderedDict()
+
+    def get(self, filename):
+        """Returns an open ZimFile for filename, opening it if needed"""
+        st = os.stat(filename)
+        stamp = (st.st_mtime, st.st_size)
+        now = time.time()
+        with self.lock:
+            self._evict_idle(now)
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                if entry[1] == stamp:
+                    entry[2] = now
+                    self.entries[filename] = entry
+                    return entry[0]
+                logger.info("Reopening changed ZIM file %s" % filename)
+                self._release(entry[0])
+
+        zim_file = ZimFile(filename)
+        zim_file.load_url_index(build=False)
+        zim_file.load_redirect_map(build=False)
+        with self.lock:
+            # Another thread may have opened the same file meanwhile
+            entry = self.entries.get(filename)
+            if entry is not None and entry[1] == stamp:
+                return entry[0]
+            self.entries[filename] = [zim_file, stamp, now]
+            while len(self.entries) > self.max_open:
+                name, (evicted, evicted_stamp, last_used) = self.entries.popitem(last=False)
+                self._release(evicted)
+        return zim_file
+
+    def _evict_idle(self, now):
+        while self.entries:
+            name, entry = next(self.entries.iteritems())
+            if now - entry[2] < self.idle_timeout:
+                break
+            del self.entries[name]
+            self._release(entry[0])
+
+    def _release(self, zim_file):
+        # Cached clusters hold views into the file's memory map and
+        # partially decompressed ones its reader, which would keep the
+        # file open after it leaves the pool
+        zim_file.clusterCache.discard_zim(zim_file.uuid)
+
+    def set_limits(self, max_open, idle_timeout):
+        """Sets the maximum number of open files and the idle timeout in seconds"""
+        with self.lock:
+            self.max_open = max_open
+            self.idle_timeout = idle_timeout
+
+    def clear(self):
+        with self.lock:
+            for name, entry in self.entries.items():
+                self._release(entry[0])
+            self.entries.clear()
+
+
+# The pool of ZIM files kept open for the web views of this process
+shared_zim_file_pool = ZimFilePool()
@@ -58,18 +58,16 @@ def verify_indexes(zim_files, index_dir_base, indexed_count_cache=None, verbose=
                 # awhile to compute these and they never change
                 indexed_count = zim_indexable.get(zim_fn, None)
                 if indexed_count == None:
-                    mime_type_indexes = []
+                    mime_type_names = []
                     for mt_re in DEFAULT_MIME_TYPES:
-                        for mt_idx, mt_name in enumerate(zim_obj.mimeTypeList):
+                        for mt_name in zim_obj.mimeTypeList:
                             if re.search(mt_re, mt_name):
-                                mime_type_indexes.append(mt_idx)
+                                mime_type_names.append(mt_name)
 
-                    indexed_count = 0
                     logger.debug("Checking indexable against %d articles" % zim_obj.header['articleCount'])
-                    for idx in xrange(zim_obj.header['articleCount']):
-                        article_info = zim_obj.read_directory_entry_by_index(idx)
-                        if article_info['mimetype'] in mime_type_indexes:
-                            indexed_count += 1
+                    # Selecting the articles reads each directory entry once,
+                    # which is all counting them needs
+                    indexed_count = len(zim_obj.cluster_ordered_indexes(mimetypes=mime_type_names))
                     zim_indexable[zim_fn] = indexed_count
     
                     # Store cache of indexable items in zim files
@@ -16,7 +16,7 @@ from whoosh.fields import TEXT, NUMERIC, ID, Schema
 from whoosh.qparser import QueryParser
 
 from iiab.zimpy import ZimFile
-from iiab.whoosh_search import index_directory_path
+from iiab.whoosh_search import index_directory_path, zim_static_rank
 
 # Install progress bar package as it is really needed
 # to help understand where the processing is
@@ -27,24 +27,23 @@ from html2text import html2text
 
 logger = logging.getLogger()
 
-ZIM_CACHE_SIZE = 1024
 DEFAULT_MIME_TYPES = ["text/html", "text/plain"]
 DEFAULT_MEMORY_LIMIT = 256
 DEFAULT_COMMIT_PERIOD = 300
 DEFAULT_COMMIT_LIMIT = 1000
 
-def article_info_as_unicode(articles):
-    for article_info in articles:
-        # Make any strings into unicode objects
-        for k,v in article_info.items():
-            if type(v) is str:
-                article_info[k] = unicode(v)
-        yield article_info
-
-def content_as_text(zim_obj, article_info, index):
-    "Return the contents of an article at a given index from the ZIM file as text"
+def article_info_as_unicode(entry):
+    # Copy into a dictionary we can add link counts to,
+    # making any strings into unicode objects
+    article_info = {}
+    for k,v in entry.items():
+        if type(v) is str:
+            v = unicode(v)
+        article_info[k] = v
+    return article_info
 
-    raw_content = zim_obj.get_article_by_index(index)[0]
+def content_as_text(zim_obj, article_info, raw_content):
+    "Return the raw contents of an article from the ZIM file as text"
 
     try:
         content = raw_content.decode("utf-8")
@@ -58,7 +57,7 @@ def content_as_text(zim_obj, article_info, index):
         try:
             content = html2text(content)
         except ValueError:
-            logger.error("Failed converting html to text from: %s at index: %d, skipping article" % (os.path.basename(zim_obj.filename), index))
+            logger.error("Failed converting html to text from: %s at index: %d, skipping article" % (os.path.basename(zim_obj.filename), article_info['index']))
             content = None
 
     return content
@@ -81,7 +80,10 @@ def get_schema():
                     # Links to an article from others
                     reverse_links=NUMERIC(stored=True, sortable=True),
                     # Links from an article to others
-                    forward_links=NUMERIC(stored=True, sortable=True))
+                    forward_links=NUMERIC(stored=True, sortable=True),
+                    # Image page flag and reverse links combined into one
+                    # column so searches can be sorted without stored fields
+                    static_rank=NUMERIC(bits=64, signed=False, sortable=True))
     return schema
 
 def load_links_file(zim_fn, links_dir):
@@ -120,7 +122,7 @@ class InProgress(object):
         self.article_info = {}
 
 def index_zim_file(zim_filename, output_dir=".", links_dir=None, index_contents=True, mime_types=DEFAULT_MIME_TYPES, memory_limit=DEFAULT_MEMORY_LIMIT, processors=1, commit_period=DEFAULT_COMMIT_PERIOD, commit_limit=DEFAULT_COMMIT_LIMIT, use_progress_bar=False, **kwargs):
-    zim_obj = ZimFile(zim_filename, cache_size=ZIM_CACHE_SIZE)
+    zim_obj = ZimFile(zim_filename)
 
     logger.info("Indexing: %s" % zim_filename)
 
@@ -140,11 +142,11 @@ def index_zim_file(zim_filename, output_dir=".", links_dir=None, index_contents=
     # Figure out which mime type indexes from this file we will use
     logger.debug("All mime type names: %s" % zim_obj.mimeTypeList)
     logger.info("Using mime types:")
-    mime_type_indexes = []
+    mime_type_names = []
     for mt_re in mime_types:
-        for mt_idx, mt_name in enumerate(zim_obj.mimeTypeList):
+        for mt_name in zim_obj.mimeTypeList:
             if re.search(mt_re, mt_name):
-                mime_type_indexes.append(mt_idx)
+                mime_type_names.append(mt_name)
                 logger.info(mt_name)
 
     index_dir = index_directory_path(output_dir, zim_filename)
@@ -161,10 +163,20 @@ def index_zim_file(zim_filename, output_dir=".", links_dir=None, index_contents=
         logger.debug("Creating new index")
         ix = index.create_in(index_dir, get_schema())
         searcher = None
+    # Indexes created before static_rank existed are continued without it
+    has_static_rank = 'static_rank' in ix.schema.names()
 
     writer = ix.writer(limitmb=memory_limit, procs=processors)
 
-    num_articles = zim_obj.header['articleCount']
+    # Visit articles in cluster order so that each cluster is only
+    # decompressed once no matter how articles are spread between them
+    indexes = zim_obj.cluster_ordered_indexes(mimetypes=mime_type_names)
+    if index_contents:
+        articles = zim_obj.iter_articles_with_content(indexes=indexes)
+    else:
+        articles = ((zim_obj.read_directory_entry_by_index(i), None) for i in indexes)
+
+    num_articles = len(indexes)
     if use_progress_bar:
         pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=num_articles).start()
     else:
@@ -175,7 +187,9 @@ def index_zim_file(zim_filename, output_dir=".", links_dir=None, index_contents=
     last_update = datetime.now()
     needs_commit = False
 
-    for idx, article_info in enumerate(article_info_as_unicode(zim_obj.articles())):
+    for idx, (entry, raw_content) in enumerate(articles):
+        article_info = article_info_as_unicode(entry)
+
         if use_progress_bar:
             pbar.update(idx)
         else:
@@ -192,10 +206,6 @@ def index_zim_file(zim_filename, output_dir=".", links_dir=None, index_contents=
             else:
                 update_count += 1
 
-        # Skip articles of undesired mime types
-        if article_info['mimetype'] not in mime_type_indexes:
-            continue
-
         # Protect read of existing documents as sometimes there
         # incomplete writes
         try:
@@ -204,7 +214,7 @@ def index_zim_file(zim_filename, output_dir=".", links_dir=None, index_contents=
             else:
                 existing = None
         except:
-            logger.exception("Unexpected exception when looking for existing indexed article for index: %d" % idx)
+            logger.exception("Unexpected exception when looking for existing indexed article for index: %d" % article_info['index'])
             existing = None
         
         # Skip articles that have already been indexed
@@ -212,7 +222,7 @@ def index_zim_file(zim_filename, output_dir=".", links_dir=None, index_contents=
             continue
 
         if index_contents:
-            content = content_as_text(zim_obj, article_info, idx)
+            content = content_as_text(zim_obj, article_info, raw_content)
             # Whoosh seems to take issue with empty content
             # and complains about it not being unicode ?!
             if content != None and len(content.strip()) == 0:
@@ -227,7 +237,10 @@ def index_zim_file(zim_filename, output_dir=".", links_dir=None, index_contents=
                 article_info['reverse_links'] = article_links[0]
                 article_info['forward_links'] = article_links[1]
             else:
-                logger.debug("No links info found for index: %d" % idx)
+                logger.debug("No links info found for index: %d" % article_info['index'])
+
+        if has_static_rank:
+            article_info['static_rank'] = zim_static_rank(article_info['title'], article_info.get('reverse_links'))
 
         writer.add_document(content=content, **article_info)
         needs_commit = True
@@ -17,11 +17,11 @@ sys.path.insert(0, package_dir)
 
 import iiab
 from iiab.zimpy import ZimFile, full_url
+from iiab import zim_parallel
 import iiab.timepro as timepro
 
 #import memory_profiler
 
-
 def progress_bar(name, maxval):
     widgets = [name, progressbar.Percentage(), ' ', progressbar.Bar(), ' ', progressbar.ETA()]
     pbar = progressbar.ProgressBar(widgets=widgets, maxval=maxval)
@@ -39,37 +39,51 @@ def find_urls(html):
     return re.findall(regex, html)
 
 
-def process2(zf, namespaces=['A']):
-    mime_indices = set()
-    for n, mimetype in enumerate(zf.mimeTypeList):
-        if mimetype in ['text/html; charset=utf-8', 'stylesheet/css', 'text/html']:
-            mime_indices.add(n)
+LINK_NAMESPACES = ['A']
+LINK_MIMETYPES = ['text/html; charset=utf-8', 'stylesheet/css', 'text/html']
 
-    articleCount = zf.header['articleCount']
-    progress = progress_bar("Processing " + str(articleCount) + " articles in " + os.path.basename(zf.filename), articleCount)
 
+def find_links(zf, articles):
+    """Count the inbound and outbound links of a chunk of articles,
+    run in a zim_parallel worker"""
     links = {}
 
-    articles = zf.articles()
-    for entry in articles:
-        if 'redirectIndex' not in entry.keys() and entry['mimetype'] in mime_indices and entry['namespace'] in namespaces:
-            body = zf.read_blob(entry['clusterNumber'], entry['blobNumber'])
-            body = body.decode('utf-8', errors='replace')
-            urls = find_urls(body)
-            urls = [(namespace, title) for (namespace, title) in urls if namespace in namespaces]
-
-            # Record outbound links
-            link = links.get(entry['fullUrl'], (0, 0))
-            links[entry['fullUrl']] = (link[0], link[1] + len(urls))
-
-            # Record inbound links
-            for namespace, title in urls:
-                if namespace in namespaces:
-                    full = full_url(namespace, title)
-                    link = links.get(full, (0, 0))
-                    links[full] = (link[0] + 1, link[1])
-
-            progress.update(entry['index'])
+    for entry, body in articles:
+        body = body.decode('utf-8', errors='replace')
+        urls = find_urls(body)
+        urls = [(namespace, title) for (namespace, title) in urls if namespace in LINK_NAMESPACES]
+
+        # Record outbound links
+        link = links.get(entry['fullUrl'], (0, 0))
+        links[entry['fullUrl']] = (link[0], link[1] + len(urls))
+
+        # Record inbound links
+        for namespace, title in urls:
+            full = full_url(namespace, title)
+            link = links.get(full, (0, 0))
+            links[full] = (link[0] + 1, link[1])
+
+    return links
+
+
+def merge_links(links, chunk_links):
+    for full, (inbound, outbound) in chunk_links.iteritems():
+        link = links.get(full, (0, 0))
+        links[full] = (link[0] + inbound, link[1] + outbound)
+    return links
+
+
+def process2(zf, processes=None):
+    state = {}
+
+    def progress(done, total):
+        if 'bar' not in state:
+            state['bar'] = progress_bar("Processing " + str(total) + " articles in " + os.path.basename(zf.filename), total)
+        state['bar'].update(done)
+
+    links = zim_parallel.scan(zf.filename, find_links, merge_links, {},
+                              namespaces=LINK_NAMESPACES, mimetypes=LINK_MIMETYPES,
+                              processes=processes, progress=progress)
     print
     return links
 
@@ -77,19 +91,29 @@ def process2(zf, namespaces=['A']):
 def output2(fname, zf, links):
     not_found = 0
     progress = progress_bar("Writing " + str(len(links)) + " articles in " + os.path.basename(zf.filename), len(links))
-    f = open(fname, "w")
-    f.write("INDEX\tTO\tFROM\tURL\n")
-    for idx, (fullurl, link) in enumerate(links.items()):
+
+    # Links made through redirects are credited to the article they
+    # finally redirect to
+    resolved = {}
+    for idx, (fullurl, link) in enumerate(links.iteritems()):
         if (idx % 100 == 0):
             progress.update(idx)
         namespace, url = fullurl.split("/", 1)
-        entry, m = zf.get_entry_by_url(namespace, url)
-        if entry is None:
+        m = zf.urlIndex.find(namespace, url)
+        if m is not None:
+            m = zf.resolve_redirect(m)
+        if m is None:
             not_found += 1
         else:
-            s = string.join([str(entry['index']), str(link[0]), str(link[1]), fullurl.replace("\t", " ").replace("\n", " ")], '\t')
-            s = s.encode('utf-8', errors='replace') + "\n"
-            f.write(s)
+            total = resolved.get(m, (0, 0))
+            resolved[m] = (total[0] + link[0], total[1] + link[1])
+
+    f = open(fname, "w")
+    f.write("INDEX\tTO\tFROM\tURL\n")
+    for m, link in sorted(resolved.iteritems()):
+        fullurl = zf.urlIndex.key(m)
+        s = string.join([str(m), str(link[0]), str(link[1]), fullurl.replace("\t", " ").replace("\n", " ")], '\t')
+        f.write(s + "\n")
     f.close()
     if not_found > 0:
         print
@@ -102,6 +126,8 @@ def main(argv):
                       help="Directory into which to store output")
     parser.add_option("--version", action="store_true", default=False,
                       help="Print version and quit")
+    parser.add_option("--processes", type="int", default=None,
+                      help="Number of worker processes (default: number of CPUs)")
     parser.add_option("--timepro", action="store_true", default=False,
                       help="Enable timepro performance profiler")
 
@@ -122,7 +148,7 @@ def main(argv):
         print "Processing " + zim_filename
         t0 = time.time()
 
-        zf = ZimFile(zim_filename, cache_size=1024)
+        zf = ZimFile(zim_filename, url_index=True, redirect_map=True)
 
         outname = os.path.basename(zim_filename)
         outname, ext = os.path.splitext(outname)
@@ -131,7 +157,7 @@ def main(argv):
         if os.path.exists(outname):
             print "Skipping " + zim_filename + " because output file " + outname + " already exists"
         else:
-            links = process2(zf)
+            links = process2(zf, options.processes)
             output2(outname, zf, links)
         print zim_filename + " completed in " + str((time.time() - t0)/60.0) + " minutes"
         print
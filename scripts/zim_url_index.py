@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Writes URL index and redirect map sidecar files for ZIM files so that
+# ZimFile.load_url_index() and load_redirect_map() do not need to rebuild them
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+package_dir = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, package_dir)
+
+from iiab.zimpy import ZimFile, UrlIndex, RedirectMap, url_index_filename, redirect_map_filename
+
+logger = logging.getLogger()
+
+
+def write_url_index(zim_filename, force=False):
+    index_filename = url_index_filename(zim_filename)
+    if os.path.exists(index_filename) and not force:
+        logger.info("Skipping %s because %s already exists" % (zim_filename, index_filename))
+        return
+    t0 = time.time()
+    zf = ZimFile(zim_filename)
+    index = UrlIndex.build(zf)
+    index.save(index_filename, zf.get_uuid())
+    zf.close()
+    logger.info("Wrote %s with %d entries in %.1f sec" % (index_filename, len(index), time.time() - t0))
+
+
+def write_redirect_map(zim_filename, force=False):
+    map_filename = redirect_map_filename(zim_filename)
+    if os.path.exists(map_filename) and not force:
+        logger.info("Skipping %s because %s already exists" % (zim_filename, map_filename))
+        return
+    t0 = time.time()
+    zf = ZimFile(zim_filename)
+    redirects = RedirectMap.build(zf)
+    redirects.save(map_filename, zf.get_uuid())
+    zf.close()
+    logger.info("Wrote %s with %d entries in %.1f sec" % (map_filename, len(redirects), time.time() - t0))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Writes URL index and redirect map sidecar files for ZIM files")
+    parser.add_argument("zim_files", nargs="+",
+                        help="ZIM files to index")
+    parser.add_argument("-f", "--force", dest="force", action="store_true",
+                        help="Overwrite existing sidecar files")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, format="%(message)s")
+
+    for zim_filename in args.zim_files:
+        write_url_index(zim_filename, args.force)
+        write_redirect_map(zim_filename, args.force)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
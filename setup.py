@@ -21,8 +21,7 @@ setup(
         'Flask-SQLAlchemy',
         'SQLAlchemy >= 0.8.2',
         'whoosh >= 2.6.0',
-        'backports.lzma >= 0.0.2',
-        'repoze.lru'
+        'backports.lzma >= 0.0.2'
     ]
     #data_files=[("", ["LICENSE.txt", "README.md", "INSTALL.txt"])]
 )
@@ -0,0 +1,83 @@
+# Micro-benchmark of directory entry decoding in zimpy, comparing the
+# original byte at a time string parsing with the current decoder.
+# Run from the tests directory: python perftest_dirent.py [zim file]
+
+import os
+import sys
+import shutil
+import struct
+import tempfile
+from timeit import repeat
+
+sys.path.append("..")
+from iiab import timepro
+from iiab.zimpy import ZimFile, Dirent, NULL, ARTICLE_ENTRY_FORMAT, REDIRECT_ENTRY_FORMAT
+from test_zimpy import build_zim
+
+NUMBER = 2000
+
+
+# The decoder as it was before buffered parsing
+@timepro.profile()
+def legacy_read_null_terminated(f, encoding='utf-8'):
+    s = ""
+    while True:
+        b = f.read(1)
+        if b == NULL:
+            return s.decode(encoding)
+        s = s + b
+
+
+def legacy_read_directory_entry(f, offset):
+    f.seek(offset)
+    mimetype = struct.unpack('<H', f.read(2))[0]
+    if mimetype == 0xffff:
+        rich_format = REDIRECT_ENTRY_FORMAT
+    else:
+        rich_format = ARTICLE_ENTRY_FORMAT
+    fmt = struct.Struct("<" + "".join(x[0] for x in rich_format))
+    f.seek(offset)
+    d = zip([x[1] for x in rich_format], fmt.unpack(f.read(fmt.size)))
+    url = legacy_read_null_terminated(f)
+    title = legacy_read_null_terminated(f)
+    parameter = f.read(dict(d)['parameterLen'])
+    d.extend([('url', url), ('title', title), ('parameter', parameter)])
+    return dict(d)
+
+
+def per_dirent_usec(fn, offsets):
+    def run():
+        for offset in offsets:
+            fn(offset)
+    results = repeat(run, repeat=5, number=1)
+    return min(results) / len(offsets) * 1e6
+
+
+def main(argv):
+    tmpdir = None
+    if len(argv) > 1:
+        zim_fn = argv[1]
+    else:
+        tmpdir = tempfile.mkdtemp()
+        zim_fn = os.path.join(tmpdir, "perftest.zim")
+        articles = [('A', u'Article_number_%05d' % i, u'Article number %05d' % i, 0, "<html>%d</html>" % i)
+                    for i in xrange(NUMBER)]
+        build_zim(zim_fn, articles)
+
+    seek_zf = ZimFile(zim_fn, use_mmap=False)
+    mmap_zf = ZimFile(zim_fn)
+    count = min(NUMBER, seek_zf.header['articleCount'])
+    offsets = [seek_zf.read_url_pointer(i) for i in xrange(count)]
+    legacy_f = open(zim_fn, "rb")
+
+    print "Decoding %d directory entries from %s" % (count, zim_fn)
+    print "before, byte at a time:   %6.2f usec/dirent" % per_dirent_usec(lambda o: legacy_read_directory_entry(legacy_f, o), offsets)
+    print "after, seek and read:     %6.2f usec/dirent" % per_dirent_usec(lambda o: Dirent.from_reader(seek_zf.reader, o), offsets)
+    print "after, memory mapped:     %6.2f usec/dirent" % per_dirent_usec(lambda o: Dirent.from_reader(mmap_zf.reader, o), offsets)
+
+    if tmpdir is not None:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,169 @@
+import sys
+import shutil
+import tempfile
+import unittest
+
+from whoosh import index
+from whoosh import sorting
+from whoosh.fields import Schema, ID, TEXT, NUMERIC
+from whoosh.qparser import QueryParser
+
+sys.path.append("..")
+from iiab import whoosh_search
+from iiab.whoosh_search import IndexRegistry, paginated_search, zim_static_rank, zim_static_rank_image
+
+
+def add_documents(index_dir, titles):
+    ix = index.open_dir(index_dir)
+    writer = ix.writer()
+    for title in titles:
+        writer.add_document(title=title, url=title.lower())
+    writer.commit()
+
+
+class TestIndexRegistry(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        index.create_in(self.index_dir, Schema(title=TEXT(stored=True, spelling=True),
+                                               url=ID(stored=True)))
+        add_documents(self.index_dir, [u"Apple", u"Banana"])
+        self.registry = IndexRegistry(max_idle_readers=1)
+
+    def tearDown(self):
+        self.registry.clear()
+        shutil.rmtree(self.index_dir)
+
+    def test_reuses_index_and_readers(self):
+        ix = self.registry.get(self.index_dir)
+        with self.registry.searcher(self.index_dir) as searcher:
+            reader = searcher.reader()
+            self.assertEqual(searcher.doc_count(), 2)
+        with self.registry.searcher(self.index_dir) as searcher:
+            self.assertTrue(searcher.reader() is reader)
+            # A concurrent searcher gets a reader of its own
+            with self.registry.searcher(self.index_dir) as other:
+                self.assertFalse(other.reader() is reader)
+        self.assertTrue(self.registry.get(self.index_dir) is ix)
+
+    def test_refreshes_on_new_generation(self):
+        generation = self.registry.generation(self.index_dir)
+        with self.registry.searcher(self.index_dir) as searcher:
+            self.assertEqual(searcher.doc_count(), 2)
+            add_documents(self.index_dir, [u"Cherry"])
+            # The searcher in use keeps its view of the index
+            self.assertEqual(searcher.doc_count(), 2)
+        with self.registry.searcher(self.index_dir) as searcher:
+            self.assertEqual(searcher.doc_count(), 3)
+        self.assertTrue(self.registry.generation(self.index_dir) > generation)
+
+
+class TestPaginatedSearch(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        index.create_in(self.index_dir, Schema(title=TEXT(stored=True, spelling=True),
+                                               url=ID(stored=True, sortable=True)))
+        add_documents(self.index_dir, [u"Apple %02d" % i for i in range(25)] + [u"Banana"])
+        whoosh_search.result_cache.clear()
+
+    def tearDown(self):
+        whoosh_search.shared_index_registry.clear()
+        shutil.rmtree(self.index_dir)
+
+    def urls(self, pagination):
+        return [item['url'] for item in pagination.items]
+
+    def test_pages_from_cache(self):
+        expected = [u"apple %02d" % i for i in range(25)]
+        pagination, suggestions = paginated_search(self.index_dir, ["title"], u"apple", 1, pagelen=10, sort_column="url")
+        self.assertEqual(pagination.total_count, 25)
+        self.assertEqual(self.urls(pagination), expected[:10])
+        misses = whoosh_search.result_cache.stats()['misses']
+        pagination, suggestions = paginated_search(self.index_dir, ["title"], u"apple", 3, pagelen=10, sort_column="url")
+        self.assertEqual(self.urls(pagination), expected[20:])
+        self.assertEqual(whoosh_search.result_cache.stats()['misses'], misses)
+        # Past the last page gives the last page
+        pagination, suggestions = paginated_search(self.index_dir, ["title"], u"apple", 9, pagelen=10, sort_column="url")
+        self.assertEqual(self.urls(pagination), expected[20:])
+
+    def test_beyond_cached_hits(self):
+        cached_hits = whoosh_search.CACHED_HITS
+        whoosh_search.CACHED_HITS = 5
+        try:
+            pagination, suggestions = paginated_search(self.index_dir, ["title"], u"apple", 2, pagelen=10, sort_column="url")
+        finally:
+            whoosh_search.CACHED_HITS = cached_hits
+        self.assertEqual(pagination.total_count, 25)
+        self.assertEqual(self.urls(pagination), [u"apple %02d" % i for i in range(10, 20)])
+
+    def test_new_generation_not_cached(self):
+        pagination, suggestions = paginated_search(self.index_dir, ["title"], u"banana")
+        self.assertEqual(pagination.total_count, 1)
+        add_documents(self.index_dir, [u"Banana bread"])
+        pagination, suggestions = paginated_search(self.index_dir, ["title"], u"banana")
+        self.assertEqual(pagination.total_count, 2)
+
+    def test_suggestions(self):
+        pagination, suggestions = paginated_search(self.index_dir, ["title"], u"banan")
+        self.assertEqual(pagination.total_count, 0)
+        self.assertEqual(suggestions, [u"banana"])
+
+    def test_no_suggestions_with_many_hits(self):
+        # "apple" matches more documents than the spelling threshold
+        pagination, suggestions = paginated_search(self.index_dir, ["title"], u"apple OR banan")
+        self.assertEqual(pagination.total_count, 25)
+        self.assertEqual(suggestions, [])
+
+    def test_corrections_memoized_and_budgeted(self):
+        with whoosh_search.shared_index_registry.searcher(self.index_dir) as searcher:
+            query = QueryParser("title", searcher.schema).parse(u"banan")
+            corrections = whoosh_search.get_query_corrections(searcher, query, u"banan")
+            self.assertEqual([c.string for c in corrections], [u"banana"])
+            corrector = whoosh_search.get_correctors(searcher)["title"]
+            self.assertEqual(corrector.memo.values(), [[u"banana"]])
+            self.assertTrue(whoosh_search.get_correctors(searcher)["title"] is corrector)
+            # Out of time, nothing more is looked up
+            query = QueryParser("title", searcher.schema).parse(u"aple")
+            self.assertEqual(whoosh_search.get_query_corrections(searcher, query, u"aple", time_budget=-1), [])
+
+
+class TestStaticRank(unittest.TestCase):
+    ARTICLES = [(u"Image:Paris", 50), (u"Paris", 3), (u"Paris Paris", 0), (u"Image:Paris Paris", 0),
+                (u"Paris France", 40), (u"Paris Texas", 3), (u"Paris Hilton", None)]
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        ix = index.create_in(self.index_dir, Schema(title=TEXT(stored=True),
+                                                    reverse_links=NUMERIC(stored=True, sortable=True),
+                                                    static_rank=NUMERIC(bits=64, signed=False, sortable=True)))
+        writer = ix.writer()
+        for title, links in self.ARTICLES:
+            writer.add_document(title=title, reverse_links=links or 0, static_rank=zim_static_rank(title, links))
+        writer.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def test_image_flag(self):
+        self.assertEqual(zim_static_rank_image(zim_static_rank(u"Image:Paris", 10 ** 12)), 1)
+        self.assertEqual(zim_static_rank_image(zim_static_rank(u"Paris", 10 ** 12)), 0)
+        self.assertTrue(zim_static_rank(u"Paris", 2) < zim_static_rank(u"Paris", 1))
+
+    def test_same_order_as_stored_fields(self):
+        def image_pages_last(searcher, docnum):
+            return 1 if searcher.stored_fields(docnum)['title'].startswith(u"Image:") else 0
+
+        old = sorting.MultiFacet([sorting.FunctionFacet(image_pages_last), sorting.ScoreFacet(),
+                                  sorting.FieldFacet("reverse_links", reverse=True)])
+        new = sorting.MultiFacet([sorting.TranslateFacet(zim_static_rank_image, sorting.FieldFacet("static_rank")),
+                                  sorting.ScoreFacet(), sorting.FieldFacet("static_rank")])
+        ix = index.open_dir(self.index_dir)
+        with ix.searcher() as searcher:
+            query = QueryParser("title", ix.schema).parse(u"paris")
+            old_titles = [hit['title'] for hit in searcher.search(query, sortedby=old)]
+            new_titles = [hit['title'] for hit in searcher.search(query, sortedby=new)]
+        self.assertEqual(new_titles, old_titles)
+        self.assertEqual(new_titles[-2:], [u"Image:Paris Paris", u"Image:Paris"])
+
+
+if __name__ == '__main__':
+    unittest.main()
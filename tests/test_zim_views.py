@@ -0,0 +1,111 @@
+import os
+import sys
+import zlib
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask
+
+sys.path.append("..")
+from iiab.config import load_config, config
+from iiab import zim_views
+from iiab.compression import GzipCompressor
+from test_zimpy import build_zim
+
+
+class TestZimViews(unittest.TestCase):
+    html = "<html>" + "apple " * 200 + "</html>"
+    image = os.urandom(5000)
+    articles = [('A', u'Apple', u'Apple', 0, html),
+                ('I', u'logo.png', u'logo.png', 2, image)]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        zim_dir = os.path.join(self.tmpdir, "modules", "wikipedia-zim")
+        os.makedirs(zim_dir)
+        build_zim(os.path.join(zim_dir, "fruit.zim"), self.articles, zim_uuid="views-uuid-00000")
+        load_config()
+        config().set('DEFAULT', 'knowledge_dir', self.tmpdir)
+        app = Flask(__name__)
+        app.register_blueprint(zim_views.blueprint, url_prefix='/iiab/zim')
+        GzipCompressor(app)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        zim_views.shared_zim_file_pool.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def get(self, url, **headers):
+        return self.client.get(url, headers=headers)
+
+    def test_gzip_negotiation(self):
+        response = self.get('/iiab/zim/fruit/A/Apple', **{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        etag, weak = response.get_etag()
+        self.assertTrue(etag.endswith('-gzip'))
+        self.assertEqual(zlib.decompress(response.data, 16 + zlib.MAX_WBITS), self.html)
+
+        for accept in (None, 'gzip;q=0', 'identity'):
+            headers = {'Accept-Encoding': accept} if accept else {}
+            response = self.get('/iiab/zim/fruit/A/Apple', **headers)
+            self.assertEqual(response.headers.get('Content-Encoding'), None)
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(response.get_etag()[0] + '-gzip', etag)
+            self.assertEqual(response.data, self.html)
+
+    def test_not_modified(self):
+        response = self.get('/iiab/zim/fruit/A/Apple', **{'Accept-Encoding': 'gzip'})
+        etag = response.headers['ETag']
+        response = self.get('/iiab/zim/fruit/A/Apple', **{'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.data, '')
+
+        # Images are never compressed, so their responses do not vary
+        response = self.get('/iiab/zim/fruit/I/logo.png')
+        self.assertFalse('Vary' in response.headers)
+        response = self.get('/iiab/zim/fruit/I/logo.png', **{'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse('Vary' in response.headers)
+
+    def test_ranges(self):
+        size = len(self.image)
+        response = self.get('/iiab/zim/fruit/I/logo.png', **{'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], 'bytes 10-19/%d' % size)
+        self.assertEqual(response.data, self.image[10:20])
+        etag = response.headers['ETag']
+
+        response = self.get('/iiab/zim/fruit/I/logo.png', **{'Range': 'bytes=%d-' % size})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */%d' % size)
+
+        response = self.get('/iiab/zim/fruit/I/logo.png', **{'Range': 'bytes=10-19', 'If-Range': etag})
+        self.assertEqual(response.status_code, 206)
+        # A stale validator asks for the whole blob
+        response = self.get('/iiab/zim/fruit/I/logo.png', **{'Range': 'bytes=10-19', 'If-Range': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.image)
+
+    def test_streamed_blob(self):
+        chunk_size = zim_views.BLOB_CHUNK_SIZE
+        zim_views.BLOB_CHUNK_SIZE = 1024
+        try:
+            response = self.get('/iiab/zim/fruit/I/logo.png')
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.headers['Content-Length'], str(len(self.image)))
+            self.assertEqual(response.data, self.image)
+
+            response = self.get('/iiab/zim/fruit/I/logo.png', **{'Range': 'bytes=1000-3999'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.headers['Content-Length'], '3000')
+            self.assertEqual(response.data, self.image[1000:4000])
+        finally:
+            zim_views.BLOB_CHUNK_SIZE = chunk_size
+
+
+if __name__ == '__main__':
+    unittest.main()
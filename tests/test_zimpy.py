@@ -0,0 +1,461 @@
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+
+sys.path.append("..")
+from iiab import zimpy, zim_parallel
+from iiab.zimpy import ZimFile, lzma
+
+MIMETYPES = ["text/html", "text/css", "image/png"]
+
+
+def blob_lengths(zim_file, articles):
+    return dict((entry['fullUrl'], len(blob)) for entry, blob in articles)
+
+
+def merge_dicts(a, b):
+    a.update(b)
+    return a
+
+
+def build_zim(filename, articles, redirects=(), main_url=None, zim_uuid="0123456789abcdef"):
+    """Writes a small ZIM file.
+
+    articles is a list of (namespace, url, title, mimetype index, content)
+    and redirects a list of (namespace, url, title, target namespace, target url).
+    Blobs are dealt round-robin between an uncompressed and a compressed
+    cluster so that URL order and cluster order differ."""
+    entries = [dict(namespace=ns, url=url, title=title, mimetype=mt, content=content)
+               for ns, url, title, mt, content in articles]
+    entries += [dict(namespace=ns, url=url, title=title, target=(tns, turl))
+                for ns, url, title, tns, turl in redirects]
+    entries.sort(key=lambda e: (e['namespace'], e['url']))
+    index_of = dict(((e['namespace'], e['url']), i) for i, e in enumerate(entries))
+
+    clusters = [[], []]
+    for e in entries:
+        if 'content' in e:
+            cluster = len([x for x in entries[:index_of[(e['namespace'], e['url'])]] if 'content' in x]) % 2
+            e['cluster'] = cluster
+            e['blob'] = len(clusters[cluster])
+            clusters[cluster].append(e['content'])
+
+    mime_list = "".join(m + "\0" for m in MIMETYPES) + "\0"
+    dirents = []
+    for e in entries:
+        if 'target' in e:
+            d = struct.pack('<HBcII', 0xffff, 0, e['namespace'], 0, index_of[e['target']])
+        else:
+            d = struct.pack('<HBcIII', e['mimetype'], 0, e['namespace'], 0, e['cluster'], e['blob'])
+        d += e['url'].encode('utf-8') + "\0" + e['title'].encode('utf-8') + "\0"
+        dirents.append(d)
+
+    cluster_data = []
+    for n, blobs in enumerate(clusters):
+        offsets = [4 * (len(blobs) + 1)]
+        for blob in blobs:
+            offsets.append(offsets[-1] + len(blob))
+        data = struct.pack('<%dI' % len(offsets), *offsets) + "".join(blobs)
+        if n == 1:
+            cluster_data.append(chr(4) + lzma.compress(data))
+        else:
+            cluster_data.append(chr(1) + data)
+
+    n = len(entries)
+    mime_pos = 80
+    url_ptr_pos = mime_pos + len(mime_list)
+    title_ptr_pos = url_ptr_pos + 8 * n
+    dirent_pos = title_ptr_pos + 4 * n
+    url_ptrs = []
+    pos = dirent_pos
+    for d in dirents:
+        url_ptrs.append(pos)
+        pos += len(d)
+    cluster_ptr_pos = pos
+    cluster_ptrs = []
+    pos = cluster_ptr_pos + 8 * len(cluster_data)
+    for c in cluster_data:
+        cluster_ptrs.append(pos)
+        pos += len(c)
+    checksum_pos = pos
+
+    title_order = sorted(range(n), key=lambda i: (entries[i]['namespace'], entries[i]['title'] or entries[i]['url']))
+    if main_url is not None:
+        main_page = index_of[main_url]
+    else:
+        main_page = 0xffffffff
+
+    header = struct.pack('<II16sIIQQQQIIQ', 72173914, 5, zim_uuid, n, len(cluster_data),
+                         url_ptr_pos, title_ptr_pos, cluster_ptr_pos, mime_pos,
+                         main_page, 0xffffffff, checksum_pos)
+    with open(filename, "wb") as f:
+        f.write(header)
+        f.write(mime_list)
+        f.write(struct.pack('<%dQ' % n, *url_ptrs))
+        f.write(struct.pack('<%dI' % n, *title_order))
+        f.write("".join(dirents))
+        f.write(struct.pack('<%dQ' % len(cluster_ptrs), *cluster_ptrs))
+        f.write("".join(cluster_data))
+        f.write("\0" * 16)
+
+
+class TestZimFile(unittest.TestCase):
+    articles = [('A', u'Apple', u'Apple', 0, "<html>apple</html>"),
+                ('A', u'Banana', u'Banana', 0, "<html>banana</html>"),
+                ('A', u'Caf\xe9', u'Caf\xe9', 0, "<html>cafe</html>"),
+                ('A', u'Cherry', u'Cherry', 0, "<html>cherry</html>"),
+                ('-', u's/style.css', u's/style.css', 1, "body {}"),
+                ('I', u'logo.png', u'logo.png', 2, "\x89PNG" + "\0" * 300),
+                ('M', u'Language', u'Language', 0, "eng"),
+                ('A', u'Z' * 400, u'Z' * 400, 0, "<html>long</html>"),
+                ('M', u'Title', u'Title', 0, "Fruit")]
+    redirects = [('A', u'Apples', u'Apples', 'A', u'Apple'),
+                 ('A', u'Pomme', u'Pomme', 'A', u'Apples')]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "test.zim")
+        build_zim(self.filename, self.articles, self.redirects, main_url=('A', u'Banana'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def open_all(self):
+        """Open the test file with each of the reader implementations"""
+        zfs = [ZimFile(self.filename, use_mmap=False), ZimFile(self.filename)]
+        windowed = ZimFile(self.filename)
+        windowed.reader.close()
+        windowed.reader = zimpy.MmapReader(self.filename, window_size=1)
+        zfs.append(windowed)
+        return zfs
+
+    def test_articles_by_url(self):
+        for zf in self.open_all():
+            for ns, url, title, mt, content in self.articles:
+                article, mime, namespace = zf.get_article_by_url(ns, url)
+                self.assertEqual(article, content)
+                self.assertEqual(mime, MIMETYPES[mt])
+                self.assertEqual(namespace, ns)
+                view = zf.get_article_by_url(ns, url, view=True)[0]
+                self.assertTrue(isinstance(view, buffer))
+                self.assertEqual(str(view), content)
+            self.assertEqual(zf.get_article_by_url('A', u'Durian'), (None, None, None))
+            zf.close()
+
+    def test_open_blob(self):
+        for zf in self.open_all():
+            for ns, url, title, mt, content in self.articles:
+                entry = zf.get_entry_by_url(ns, url)[0]
+                size, read = zf.open_blob(entry.clusterNumber, entry.blobNumber)
+                self.assertEqual(size, len(content))
+                self.assertEqual(read(0, size), content)
+                self.assertEqual(read(2, 3), content[2:5])
+            self.assertRaises(IOError, zf.open_blob, 0, 100)
+            zf.close()
+
+    def test_redirects(self):
+        for zf in self.open_all():
+            self.assertEqual(zf.get_article_by_url('A', u'Pomme')[0], "<html>apple</html>")
+            zf.close()
+
+    def test_main_page_and_metadata(self):
+        for zf in self.open_all():
+            self.assertEqual(zf.get_main_page()[0], "<html>banana</html>")
+            self.assertEqual(zf.metadata(), {'language': "eng", 'title': "Fruit"})
+            self.assertEqual(zf.mimeTypeList, MIMETYPES)
+            zf.close()
+
+    def test_namespace_ranges(self):
+        zf = ZimFile(self.filename)
+        self.assertEqual(zf.namespaceRanges.keys(), ['-', 'A', 'I', 'M'])
+        self.assertEqual(zf.namespace_count('A'), 7)
+        self.assertEqual(zf.namespace_count('Z'), 0)
+        self.assertEqual([e['url'] for e in zf.articles('M')], [u'Language', u'Title'])
+        self.assertEqual(list(zf.articles('Z')), [])
+        self.assertEqual(zf.get_article_by_url('Z', u'Zebra'), (None, None, None))
+        zf.close()
+
+    def test_url_index(self):
+        zf = ZimFile(self.filename, url_index=True)
+        for i in xrange(zf.header['articleCount']):
+            entry = zf.read_directory_entry_by_index(i)
+            self.assertEqual(zf.urlIndex.find(entry['namespace'], entry['url']), i)
+        self.assertEqual(zf.urlIndex.find('A', u'Durian'), None)
+        self.assertEqual(zf.urlIndex.find('Z', u'Zebra'), None)
+        self.assertEqual(zf.get_article_by_url('A', u'Caf\xe9')[0], "<html>cafe</html>")
+
+        sidecar = zimpy.url_index_filename(self.filename)
+        zf.urlIndex.save(sidecar, zf.get_uuid())
+        loaded = zimpy.UrlIndex.load(sidecar, zf.get_uuid())
+        self.assertEqual(loaded.keys, zf.urlIndex.keys)
+        self.assertEqual(loaded.offsets, zf.urlIndex.offsets)
+        zf.close()
+
+    def test_redirect_map(self):
+        zf = ZimFile(self.filename, redirect_map=True)
+        apple = zf.get_entry_by_url('A', u'Apple')[1]
+        for url in (u'Apple', u'Apples', u'Pomme'):
+            self.assertEqual(zf.redirectMap.resolve(zf.get_entry_by_url('A', url)[1]), apple)
+        self.assertEqual(zf.get_article_by_url('A', u'Pomme')[0], "<html>apple</html>")
+
+        sidecar = zimpy.redirect_map_filename(self.filename)
+        zf.redirectMap.save(sidecar, zf.get_uuid())
+        self.assertEqual(zimpy.RedirectMap.load(sidecar, zf.get_uuid()).targets, zf.redirectMap.targets)
+        zf.close()
+        # The rebuilt file below has the same UUID
+        os.remove(sidecar)
+
+        build_zim(self.filename, self.articles, [('A', u'Loop', u'Loop', 'A', u'Pool'),
+                                                 ('A', u'Pool', u'Pool', 'A', u'Loop'),
+                                                 ('A', u'ToLoop', u'ToLoop', 'A', u'Loop')])
+        for redirect_map in (False, True):
+            zf = ZimFile(self.filename, redirect_map=redirect_map)
+            for url in (u'Loop', u'Pool', u'ToLoop'):
+                self.assertEqual(zf.get_article_by_url('A', url), (None, None, None))
+            zf.close()
+
+    def test_search_titles(self):
+        zf = ZimFile(self.filename)
+        titles = [e['title'] for e in zf.search_titles(u'C')]
+        self.assertEqual(titles, [u'Caf\xe9', u'Cherry'])
+        titles = [e['title'] for e in zf.search_titles(u'Ap')]
+        self.assertEqual(titles, [u'Apple', u'Apples'])
+        self.assertEqual(len(zf.search_titles(u'', limit=3)), 3)
+        self.assertEqual(zf.search_titles(u'Durian'), [])
+        self.assertEqual([e['url'] for e in zf.search_titles(u'L', namespace='M')], [u'Language'])
+        zf.close()
+
+    def test_dirents(self):
+        zf = ZimFile(self.filename, dirent_cache_size=4)
+        entry, idx = zf.get_entry_by_url('A', u'Pomme')
+        self.assertTrue(entry.is_redirect())
+        self.assertTrue('redirectIndex' in entry)
+        self.assertFalse('clusterNumber' in entry)
+        self.assertRaises(KeyError, lambda: entry['clusterNumber'])
+        self.assertEqual(entry['fullUrl'], u'A/Pomme')
+        self.assertEqual(dict(entry.items())['index'], idx)
+        self.assertTrue(zf.read_directory_entry_by_index(idx) is entry)
+
+        urls = [e['fullUrl'] for e in zf.articles()]
+        self.assertEqual(urls, sorted(urls))
+        self.assertEqual(len(urls), zf.header['articleCount'])
+        zf.close()
+
+    def test_lazy_decompression(self):
+        blobs = [os.urandom(5000).encode("hex") for i in xrange(50)]
+        build_zim(self.filename, [('A', u'%02d' % i, u'', 0, blob) for i, blob in enumerate(blobs)])
+        zf = ZimFile(self.filename)
+        cluster = zimpy.ClusterData(zf.reader, zf.read_cluster_pointer(1))
+        self.assertTrue(cluster.compressed)
+        self.assertEqual(cluster.read_blob(0), blobs[1])
+        self.assertFalse(cluster.is_complete())
+        first = cluster.read_blob_view(1)
+        self.assertEqual(cluster.read_blob(24), blobs[49])
+        self.assertTrue(cluster.is_complete())
+        self.assertEqual(str(first), blobs[3])
+
+        # Reading blob by blob grows the data geometrically
+        cluster = zimpy.ClusterData(zf.reader, zf.read_cluster_pointer(1))
+        lengths = set()
+        for i in xrange(25):
+            self.assertEqual(cluster.read_blob(i), blobs[2 * i + 1])
+            lengths.add(len(cluster.data))
+        self.assertTrue(len(lengths) <= 6, sorted(lengths))
+        zf.close()
+
+    def test_cluster_cache(self):
+        blobs = [os.urandom(5000).encode("hex") for i in xrange(50)]
+        build_zim(self.filename, [('A', u'%02d' % i, u'', 0, blob) for i, blob in enumerate(blobs)])
+        cache = zimpy.ClusterCache(budget=400000)
+        # Read through a file object so uncompressed clusters are copies on the heap
+        zf = ZimFile(self.filename, use_mmap=False, cluster_cache=cache)
+        self.assertEqual(zf.get_article_by_url('A', u'01')[0], blobs[1])
+        self.assertEqual(zf.get_article_by_url('A', u'03')[0], blobs[3])
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['clusters']), (1, 1, 1))
+        partial = stats['bytes']
+        self.assertTrue(0 < partial < 100000)
+
+        # Both clusters no longer fit in the budget once the compressed one is complete
+        self.assertEqual(zf.get_article_by_url('A', u'49')[0], blobs[49])
+        self.assertEqual(zf.get_article_by_url('A', u'00')[0], blobs[0])
+        stats = cache.stats()
+        self.assertEqual((stats['evictions'], stats['clusters']), (1, 1))
+        self.assertTrue(stats['bytes'] <= stats['budget'])
+
+        # An incomplete cluster must not outlive the reader it decompresses from
+        self.assertEqual(zf.get_article_by_url('A', u'01')[0], blobs[1])
+        zf.close()
+        zf = ZimFile(self.filename, use_mmap=False, cluster_cache=cache)
+        self.assertEqual(zf.get_article_by_url('A', u'49')[0], blobs[49])
+        self.assertEqual(zf.get_article_by_url('A', u'00')[0], blobs[0])
+        zf.close()
+
+    def test_uncompressed_cluster_nbytes(self):
+        blobs = [os.urandom(5000).encode("hex") for i in xrange(10)]
+        build_zim(self.filename, [('A', u'%02d' % i, u'', 0, blob) for i, blob in enumerate(blobs)])
+        for zf in self.open_all():
+            cluster = zimpy.ClusterData(zf.reader, zf.read_cluster_pointer(0))
+            self.assertFalse(cluster.compressed)
+            offsets_size = cluster.offsets.itemsize * len(cluster.offsets)
+            if zf.reader.views_are_copies():
+                self.assertEqual(cluster.nbytes(), offsets_size + len(cluster.data))
+            else:
+                # Only the offsets count for data viewed in the memory map
+                self.assertEqual(cluster.nbytes(), offsets_size)
+            zf.close()
+
+    def test_concurrent_reads(self):
+        blobs = [os.urandom(2000).encode("hex") for i in xrange(40)]
+        build_zim(self.filename, [('A', u'%02d' % i, u'', 0, blob) for i, blob in enumerate(blobs)])
+        for zf in self.open_all():
+            zf.clusterCache = zimpy.ClusterCache(budget=50000)
+            zf.direntCache = zimpy.DirentCache(8)
+            errors = []
+
+            def run(seed):
+                try:
+                    for n in xrange(50):
+                        i = (seed * 7 + n * 13) % len(blobs)
+                        if zf.get_article_by_url('A', u'%02d' % i)[0] != blobs[i]:
+                            errors.append(i)
+                except Exception, e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=run, args=(seed,)) for seed in xrange(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+            zf.close()
+
+    def test_mmap_window_reuse(self):
+        articles = [('A', u'Article %03d %s' % (i, u'x' * 40), u'', 0, "<html>%d</html>" % i) for i in xrange(400)]
+        build_zim(self.filename, articles, zim_uuid="window-uuid-0000")
+        remaps = []
+        for window_count in (1, 4):
+            zf = ZimFile(self.filename)
+            zf.reader.close()
+            zf.reader = zimpy.MmapReader(self.filename, window_size=1, window_count=window_count)
+            for ns, url, title, mt, content in articles[::7]:
+                self.assertEqual(zf.get_article_by_url(ns, url)[0], content)
+            remaps.append(zf.reader.remaps)
+            # Looking up the same article again stays within the windows
+            zf.get_article_by_url('A', articles[-1][1])
+            if window_count > 1:
+                self.assertEqual(zf.reader.remaps, remaps[-1])
+            zf.close()
+        # Bisecting alternates between the pointer list and the directory
+        # entries, which a single window has to remap for on every probe
+        self.assertTrue(remaps[1] * 4 < remaps[0], remaps)
+
+    def test_zim_file_pool(self):
+        other = os.path.join(self.tmpdir, "other.zim")
+        build_zim(other, self.articles)
+        pool = zimpy.ZimFilePool(max_open=1, idle_timeout=60)
+        zf = pool.get(self.filename)
+        self.assertTrue(pool.get(self.filename) is zf)
+        self.assertTrue(pool.get(other) is not zf)
+        self.assertEqual(pool.entries.keys(), [other])
+
+        zf = pool.get(other)
+        os.utime(other, (0, 0))
+        self.assertTrue(pool.get(other) is not zf)
+
+        pool.set_limits(1, 0)
+        zf = pool.get(other)
+        self.assertTrue(pool.get(other) is not zf)
+        self.assertRaises(OSError, pool.get, os.path.join(self.tmpdir, "missing.zim"))
+        pool.clear()
+
+    def test_zim_file_pool_releases_clusters(self):
+        filenames = []
+        for i in xrange(4):
+            filename = os.path.join(self.tmpdir, "pool%d.zim" % i)
+            build_zim(filename, self.articles, zim_uuid="pool-uuid-%06d" % i)
+            filenames.append(filename)
+        cache = zimpy.ClusterCache()
+        pool = zimpy.ZimFilePool(max_open=2, idle_timeout=60)
+        for filename in filenames:
+            zf = pool.get(filename)
+            zf.clusterCache = cache
+            for ns, url, title, mt, content in self.articles:
+                zf.get_article_by_url(ns, url)
+        # Only the clusters of the files still in the pool are cached,
+        # and complete clusters no longer hold their reader
+        open_uuids = set(entry[0].uuid for entry in pool.entries.values())
+        self.assertEqual(set(key[0] for key in cache.entries), open_uuids)
+        self.assertEqual(len(cache.entries), 4)
+        for cluster, nbytes in cache.entries.values():
+            self.assertTrue(cluster.reader is None)
+        pool.clear()
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_zim_file_pool_sidecars(self):
+        pool = zimpy.ZimFilePool()
+        # Without sidecars nothing is built while serving
+        zf = pool.get(self.filename)
+        self.assertEqual((zf.urlIndex, zf.redirectMap), (None, None))
+        zimpy.UrlIndex.build(zf).save(zimpy.url_index_filename(self.filename), zf.get_uuid())
+        zimpy.RedirectMap.build(zf).save(zimpy.redirect_map_filename(self.filename), zf.get_uuid())
+        # Sidecars are renamed into place, leaving no temporary files
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["test.zim", "test.zim.redirects", "test.zim.urlidx"])
+        self.assertEqual(os.stat(zimpy.url_index_filename(self.filename)).st_mode & 0777, 0644)
+        pool.clear()
+        zf = pool.get(self.filename)
+        self.assertTrue(zf.urlIndex is not None and zf.redirectMap is not None)
+        entry, index = zf.get_entry_by_url('A', u'Pomme')
+        self.assertEqual(zf.read_directory_entry_by_index(zf.resolve_redirect(index)).url, u'Apple')
+        pool.clear()
+
+    def test_unusable_sidecars_ignored(self):
+        zf = ZimFile(self.filename)
+        index_filename = zimpy.url_index_filename(self.filename)
+        map_filename = zimpy.redirect_map_filename(self.filename)
+        zimpy.UrlIndex.build(zf).save(index_filename, zf.get_uuid())
+        with open(index_filename, "r+b") as f:
+            f.truncate(os.path.getsize(index_filename) - 5)
+        # A map for a file with fewer entries
+        zimpy.RedirectMap(zimpy.array('I', [0, 1])).save(map_filename, zf.get_uuid())
+        self.assertEqual(zf.load_url_index(build=False), None)
+        self.assertEqual(zf.load_redirect_map(build=False), None)
+        with open(index_filename, "wb") as f:
+            f.write("ZIMURLX1")
+        self.assertEqual(len(zf.load_url_index()), len(self.articles) + len(self.redirects))
+        entry, index = zf.get_entry_by_url('A', u'Pomme')
+        self.assertEqual(zf.read_directory_entry_by_index(zf.resolve_redirect(index)).url, u'Apple')
+        zf.close()
+
+    def test_iter_articles_with_content(self):
+        zf = ZimFile(self.filename)
+        found = [(e['url'], blob) for e, blob in zf.iter_articles_with_content(namespaces=['A'], mimetypes=['text/html'])]
+        expected = [(url, content) for ns, url, title, mt, content in self.articles if ns == 'A']
+        self.assertEqual(sorted(found), sorted(expected))
+        clusters = [e.clusterNumber for e, blob in zf.iter_articles_with_content()]
+        self.assertEqual(clusters, sorted(clusters))
+        self.assertEqual(len(clusters), len(self.articles))
+        zf.close()
+
+    def test_parallel_scan(self):
+        blobs = [os.urandom(500).encode("hex") for i in xrange(50)]
+        build_zim(self.filename, [('A', u'%02d' % i, u'', 0, blob) for i, blob in enumerate(blobs)])
+        zf = ZimFile(self.filename)
+        indexes = zf.cluster_ordered_indexes()
+        chunks = zim_parallel.split_at_clusters(zf, indexes, 3)
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(sum(chunks, zimpy.array('I')), indexes)
+        zf.close()
+
+        expected = dict((u'A/%02d' % i, len(blob)) for i, blob in enumerate(blobs))
+        for processes in (1, 2):
+            lengths = zim_parallel.scan(self.filename, blob_lengths, merge_dicts, {}, processes=processes)
+            self.assertEqual(lengths, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()